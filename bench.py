@@ -0,0 +1,438 @@
+# bench.py - Offline load test for san.py
+"""Drives san.py headlessly across concurrent simulated sessions without network access.
+
+google.generativeai, gTTS and streamlit_mic_recorder are replaced by deterministic
+local stubs with configurable latency and payload size, and each session is a
+Streamlit AppTest that signs up and then cycles through chat, audio playback, quiz,
+recitation, voice input and persona switching. The report lists p50/p95/p99 latency
+per action (one action is a widget interaction plus every rerun it triggers) and per
+individual rerun, overall throughput and peak RSS per session.
+
+AppTest swaps process-global Streamlit state on every run, so concurrent sessions
+run in forked worker processes (one per session) rather than threads. The disk
+tiers (TTS cache, shloka index, session database) are shared between them as they
+would be between server processes; in-memory caches are per worker.
+
+Usage:
+    python bench.py --sessions 8 --iterations 5
+    python bench.py --sessions 32 --model-latency-ms 400 --json bench_output.json
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import types
+import wave
+from collections import defaultdict
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "san.py")
+
+QUIZ_QUESTION = {
+    "question": "Which of these words means 'knowledge'?",
+    "options": ["vidyā", "jala", "agni", "vṛkṣa"],
+    "answer": "vidyā",
+    "explanation": "vidyā (विद्या) is knowledge or learning.",
+}
+
+# --- Stub Backends ---
+class StubConfig:
+    """Latency and payload knobs shared by all stubs."""
+
+    def __init__(self, model_latency_ms, chunk_count, reply_chars, tts_latency_ms, tts_bytes, recording_seconds):
+        self.model_latency = model_latency_ms / 1000
+        self.chunk_count = max(1, chunk_count)
+        self.reply_chars = reply_chars
+        self.tts_latency = tts_latency_ms / 1000
+        self.tts_bytes = tts_bytes
+        self.recording_seconds = recording_seconds
+
+def _usage(prompt_chars, reply_chars):
+    return types.SimpleNamespace(
+        prompt_token_count=prompt_chars // 4,
+        candidates_token_count=reply_chars // 4,
+        total_token_count=(prompt_chars + reply_chars) // 4,
+    )
+
+def _reply_text(config, prompt_chars):
+    """A deterministic reply of the configured size, mixing Devanagari and IAST like real answers."""
+    base = f"धर्म (dharma) means duty, law and right conduct. [{prompt_chars}] "
+    return (base * (config.reply_chars // len(base) + 1))[: config.reply_chars]
+
+def make_genai_stub(config):
+    """Builds a stand-in for the google.generativeai module."""
+    genai = types.ModuleType("google.generativeai")
+    caching = types.ModuleType("google.generativeai.caching")
+
+    class CachedContent:
+        """Holds the instruction locally; creating one costs a model round trip, like the real API."""
+
+        def __init__(self, model, system_instruction, ttl):
+            self.name = f"cachedContents/stub-{id(self)}"
+            self.model = model
+            self.system_instruction = system_instruction
+            self.ttl = ttl
+
+        @classmethod
+        def create(cls, model, system_instruction=None, ttl=None, **kwargs):
+            time.sleep(config.model_latency)
+            return cls(model, system_instruction, ttl)
+
+    caching.CachedContent = CachedContent
+
+    class GenerativeModel:
+        def __init__(self, model_name="gemini-1.5-flash", **config_kwargs):
+            self.model_name = model_name
+            self.config = config_kwargs
+
+        @classmethod
+        def from_cached_content(cls, cached_content):
+            return cls(cached_content.model, system_instruction=cached_content.system_instruction)
+
+        def generate_content(self, contents, stream=False, generation_config=None, **kwargs):
+            prompt_chars = len(json.dumps(contents, default=lambda o: "<binary>", ensure_ascii=False))
+            schema = (generation_config or {}).get("response_schema") if isinstance(generation_config, dict) else None
+            if schema and schema.get("type") == "array":
+                time.sleep(config.model_latency)
+                batch = [dict(QUIZ_QUESTION, question=f"{QUIZ_QUESTION['question']} (#{i})") for i in range(10)]
+                return types.SimpleNamespace(text=json.dumps(batch, ensure_ascii=False), usage_metadata=_usage(prompt_chars, 400))
+            if schema and "transcript" in schema.get("properties", {}):
+                time.sleep(config.model_latency)
+                answer = _reply_text(config, prompt_chars)
+                text = json.dumps({"transcript": "What does dharma mean?", "answer": answer}, ensure_ascii=False)
+                return types.SimpleNamespace(text=text, usage_metadata=_usage(prompt_chars, len(text)))
+            reply = _reply_text(config, prompt_chars)
+            if not stream:
+                time.sleep(config.model_latency)
+                return types.SimpleNamespace(text=reply, usage_metadata=_usage(prompt_chars, len(reply)))
+            return self._stream(reply, prompt_chars)
+
+        def _stream(self, reply, prompt_chars):
+            size = -(-len(reply) // config.chunk_count)
+            for i in range(config.chunk_count):
+                time.sleep(config.model_latency / config.chunk_count)
+                last = i == config.chunk_count - 1
+                yield types.SimpleNamespace(
+                    text=reply[i * size:(i + 1) * size],
+                    usage_metadata=_usage(prompt_chars, len(reply)) if last else None,
+                )
+
+    def upload_file(data, mime_type=None, **kwargs):
+        time.sleep(config.model_latency / 4)
+        return types.SimpleNamespace(name=f"files/stub-{id(data)}", mime_type=mime_type)
+
+    def delete_file(name, **kwargs):
+        time.sleep(config.model_latency / 4)
+
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = GenerativeModel
+    genai.upload_file = upload_file
+    genai.delete_file = delete_file
+    genai.caching = caching
+    return genai
+
+def make_gtts_stub(config):
+    """Builds a stand-in for the gtts module producing fixed-size fake MP3 payloads."""
+    gtts = types.ModuleType("gtts")
+
+    class gTTS:
+        def __init__(self, text, lang="en", slow=False, **kwargs):
+            self.text = text
+
+        def write_to_fp(self, fp):
+            time.sleep(config.tts_latency)
+            seed = self.text.encode("utf-8")[:64] or b"-"
+            fp.write((b"ID3" + seed * (config.tts_bytes // len(seed) + 1))[: config.tts_bytes])
+
+    gtts.gTTS = gTTS
+    return gtts
+
+def make_recording(seconds, rate=48000):
+    """A stereo 16-bit WAV of a tone padded with silence, like a short spoken clip."""
+    import numpy as np
+    t = np.arange(int(seconds * rate)) / rate
+    tone = 0.3 * np.sin(2 * np.pi * 220 * t) * ((t > seconds * 0.2) & (t < seconds * 0.8))
+    pcm = (np.repeat(tone[:, None], 2, axis=1) * 32767).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+def make_mic_recorder_stub(config):
+    """Builds a stand-in for streamlit_mic_recorder.
+
+    A session "records" by setting ``st.session_state["_bench_record"] = True``; the
+    next mic_recorder call returns one clip and clears the flag, like just_once=True.
+    """
+    module = types.ModuleType("streamlit_mic_recorder")
+    recording = make_recording(config.recording_seconds)
+    counter = iter(range(1, 1 << 62))
+
+    def mic_recorder(start_prompt="Start recording", stop_prompt="Stop recording", just_once=False,
+                     use_container_width=False, format="webm", callback=None, args=(), kwargs={}, key=None):
+        import streamlit as st
+        if not st.session_state.pop("_bench_record", False):
+            return None
+        return {"bytes": recording, "sample_rate": 48000, "sample_width": 2, "format": "wav", "id": next(counter)}
+
+    module.mic_recorder = mic_recorder
+    return module
+
+def install_stubs(config):
+    """Swaps the app's network-bound dependencies for the stubs in sys.modules."""
+    genai = make_genai_stub(config)
+    sys.modules["google.generativeai"] = genai
+    sys.modules["google.generativeai.caching"] = genai.caching
+    try:
+        import google
+        google.generativeai = genai
+    except ImportError:
+        pass
+    sys.modules["gtts"] = make_gtts_stub(config)
+    sys.modules["streamlit_mic_recorder"] = make_mic_recorder_stub(config)
+
+# --- Simulated Sessions ---
+def _button(at, label):
+    for button in list(at.sidebar.button) + list(at.button):
+        if button.label == label:
+            return button
+    raise LookupError(f"No button labelled {label!r}; page shows {[b.label for b in at.button]}")
+
+class SimulatedSession:
+    """One learner: signs up, then cycles through every feature of the chatbot page."""
+
+    PERSONAS = ["General", "Grammar (Pāṇini AI)", "Ayurveda (Charak AI)", "Literature (Vyasa AI)"]
+
+    def __init__(self, index, timeout):
+        from streamlit.testing.v1 import AppTest
+        self.index = index
+        self.timeout = timeout
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.samples = defaultdict(list)
+        self.reruns = []
+        self.errors = defaultdict(int)
+        # Every rerun, direct or from a widget, goes through AppTest._run; time each one on its own
+        run = self.at._run
+        def timed_run(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return run(*args, **kwargs)
+            finally:
+                self.reruns.append((time.perf_counter() - started) * 1000)
+        self.at._run = timed_run
+
+    def _timed(self, action, fn):
+        started = time.perf_counter()
+        try:
+            fn()
+            if self.at.exception:
+                raise RuntimeError(self.at.exception[0].message)
+        except Exception:
+            self.errors[action] += 1
+            return
+        self.samples[action].append((time.perf_counter() - started) * 1000)
+
+    def _settle(self):
+        """Reruns whenever a background job is done, like the page's job watcher, until none are left."""
+        deadline = time.monotonic() + self.timeout
+        while "background_jobs" in self.at.session_state and self.at.session_state["background_jobs"]:
+            if any(job.future.done() for job in self.at.session_state["background_jobs"].values()):
+                self.at.run()
+            elif time.monotonic() > deadline:
+                raise TimeoutError("Background jobs did not finish in time.")
+            else:
+                time.sleep(0.005)
+
+    def login(self):
+        """Creates this learner's account; the database starts empty, so there is none to log in to."""
+        def do():
+            self.at.run()
+            _button(self.at, "✨ Create Account").click().run()
+            self.at.text_input(key="signup_email").input(f"learner{self.index}@bench.local")
+            self.at.text_input(key="signup_password").input("bench")
+            _button(self.at, "🚀 Sign Up").click().run()
+            if not self.at.session_state["logged_in"]:
+                raise RuntimeError("Signup failed.")
+        self._timed("login", do)
+
+    def chat(self, text):
+        self._timed("chat", lambda: self.at.chat_input[0].set_value(text).run())
+
+    def play_audio(self):
+        def do():
+            buttons = [b for b in self.at.button if b.label == "🔊 Play Audio"]
+            if buttons:
+                buttons[-1].click().run()
+                self._settle()
+        self._timed("audio", do)
+
+    def quiz(self):
+        def do():
+            _button(self.at, "🧩 Start Quiz").click().run()
+            self._settle()
+            self.at.button(key="opt_0").click().run()
+            self.at.button(key="quiz_back").click().run()
+        self._timed("quiz", do)
+
+    def recitation(self):
+        def do():
+            _button(self.at, "🗣️ Recite a Shloka").click().run()
+            self._settle()
+            self.at.session_state["_bench_record"] = True
+            self.at.run()
+        self._timed("recitation", do)
+
+    def voice(self):
+        def do():
+            self.at.button(key="activate_voice").click().run()
+            self.at.session_state["_bench_record"] = True
+            self.at.run()
+            self._settle()
+        self._timed("voice", do)
+
+    def switch_persona(self, iteration):
+        persona = self.PERSONAS[(self.index + iteration + 1) % len(self.PERSONAS)]
+        def do():
+            selectbox = next(s for s in self.at.sidebar.selectbox if s.label == "Select AI Expert")
+            selectbox.set_value(persona).run()
+        self._timed("persona_switch", do)
+
+    def rerun(self):
+        self._timed("idle_rerun", self.at.run)
+
+    def run(self, iterations):
+        self.login()
+        for i in range(iterations):
+            self.chat("What does dharma mean?" if i % 2 == 0 else f"Explain sandhi rule number {i} for learner {self.index}.")
+            self.play_audio()
+            self.rerun()
+            self.quiz()
+            self.recitation()
+            self.voice()
+            self.switch_persona(i)
+
+def run_session(index, iterations, timeout):
+    """Worker entry point: runs one simulated session and returns its samples and memory growth."""
+    baseline = current_rss_bytes()
+    session = SimulatedSession(index, timeout)
+    session.run(iterations)
+    return {"samples": dict(session.samples), "reruns": session.reruns, "errors": dict(session.errors),
+            "rss_growth": peak_rss_bytes() - baseline}
+
+# --- Reporting ---
+def peak_rss_bytes():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024 # Linux reports KiB
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return peak_rss_bytes()
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(p * (len(sorted_values) - 1))))]
+
+def build_report(results, elapsed, baseline_rss):
+    by_action = defaultdict(list)
+    reruns = []
+    errors = defaultdict(int)
+    for result in results:
+        reruns.extend(result["reruns"])
+        for action, values in result["samples"].items():
+            by_action[action].extend(values)
+        for action, count in result["errors"].items():
+            errors[action] += count
+    all_samples = sorted(v for values in by_action.values() for v in values)
+    growth = [result["rss_growth"] for result in results]
+
+    def summary(values):
+        values = sorted(values)
+        return {
+            "count": len(values),
+            "p50_ms": percentile(values, 0.50),
+            "p95_ms": percentile(values, 0.95),
+            "p99_ms": percentile(values, 0.99),
+            "mean_ms": statistics.fmean(values) if values else 0.0,
+        }
+
+    return {
+        "sessions": len(results),
+        "elapsed_s": elapsed,
+        "actions": len(all_samples),
+        "throughput_actions_per_s": len(all_samples) / elapsed if elapsed else 0.0,
+        "overall": summary(all_samples),
+        "by_action": {action: summary(values) for action, values in sorted(by_action.items())},
+        "reruns": summary(reruns),
+        "errors": dict(errors),
+        "baseline_rss_mb": baseline_rss / 2 ** 20,
+        "peak_rss_per_session_mb": statistics.fmean(growth) / 2 ** 20 if growth else 0.0,
+        "peak_rss_per_session_max_mb": max(growth) / 2 ** 20 if growth else 0.0,
+    }
+
+def print_report(report):
+    print(f"\nSessions: {report['sessions']}   Actions: {report['actions']}   Elapsed: {report['elapsed_s']:.2f} s")
+    print(f"Throughput: {report['throughput_actions_per_s']:.1f} actions/s")
+    print(f"Peak RSS per session: {report['peak_rss_per_session_mb']:.2f} MB mean, "
+          f"{report['peak_rss_per_session_max_mb']:.2f} MB max (process baseline {report['baseline_rss_mb']:.1f} MB)\n")
+    print(f"{'action':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    rows = list(report["by_action"].items()) + [("ALL", report["overall"])]
+    for action, s in rows:
+        errors = sum(report["errors"].values()) if action == "ALL" else report["errors"].get(action, 0)
+        print(f"{action:<16}{s['count']:>7}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}{errors:>8}")
+    s = report["reruns"]
+    print(f"{'(each rerun)':<16}{s['count']:>7}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent simulated sessions")
+    parser.add_argument("--iterations", type=int, default=3, help="feature cycles per session")
+    parser.add_argument("--model-latency-ms", type=float, default=200, help="stub Gemini latency per request")
+    parser.add_argument("--chunks", type=int, default=8, help="chunks per streamed reply")
+    parser.add_argument("--reply-chars", type=int, default=800, help="characters per model reply")
+    parser.add_argument("--tts-latency-ms", type=float, default=150, help="stub gTTS latency per synthesis")
+    parser.add_argument("--tts-kb", type=int, default=48, help="bytes of fake MP3 per synthesis, in KiB")
+    parser.add_argument("--recording-seconds", type=float, default=3.0, help="length of the simulated mic clip")
+    parser.add_argument("--timeout", type=float, default=60, help="per-run AppTest timeout in seconds")
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    args = parser.parse_args(argv)
+
+    # Keep caches and the session database out of the user's real state directories
+    state_dir = tempfile.mkdtemp(prefix="sanskritai-bench-")
+    os.environ.setdefault("SANSKRITAI_CACHE_DIR", os.path.join(state_dir, "cache"))
+    os.environ.setdefault("SANSKRITAI_DB_PATH", os.path.join(state_dir, "sessions.db"))
+
+    config = StubConfig(args.model_latency_ms, args.chunks, args.reply_chars, args.tts_latency_ms,
+                        args.tts_kb * 1024, args.recording_seconds)
+    install_stubs(config)
+
+    # Import Streamlit before forking so every worker shares those pages
+    import streamlit as st
+    import streamlit.testing.v1 # noqa: F401
+    st.secrets._secrets = {"GEMINI_API_KEY": "offline-stub"}
+
+    baseline_rss = current_rss_bytes()
+    started = time.perf_counter()
+    with multiprocessing.get_context("fork").Pool(args.sessions) as pool:
+        results = pool.starmap(run_session, [(i, args.iterations, args.timeout) for i in range(args.sessions)])
+    report = build_report(results, time.perf_counter() - started, baseline_rss)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,8 +5,34 @@ import google.generativeai as genai
 import os
 import json # Import the json library to parse the model's output
 import io # Used for handling in-memory audio data
+import hashlib # Content-addressed cache keys and password hashes
+import hmac # Constant-time password checks
+import tempfile # Atomic writes into the shared disk caches
+import threading # Process-wide caches are shared by every session thread
+import time # Latency measurements
+import wave # Decoding and re-encoding recorded PCM audio
+import contextlib # Scoped upload/delete of large audio files
+import numpy as np # Vectorized audio preprocessing (installed with Streamlit)
+import mmap # Memory-mapped on-disk indexes
+import random # Weighted shloka selection
+import struct # Binary index headers
+import unicodedata # Diacritic-insensitive matching
+import re # Query normalization
+import datetime # Context cache TTLs
+import queue # Write-behind queue for the session store
+import sqlite3 # Durable session store
+import logging # Errors on background threads that have no page to show them on
+import uuid # Anonymous per-session keys for upstream fairness
+import sys # Per-session memory accounting
+from concurrent.futures import ThreadPoolExecutor # Background jobs that the page polls instead of waiting on
+import bisect # Histogram buckets
+import contextvars # Metric labels that follow work onto background threads
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # Local Prometheus metrics endpoint
+from google.api_core import exceptions as google_exceptions # Retryable upstream errors
+from collections import OrderedDict, deque, namedtuple # LRU bookkeeping, quiz pools and compact chat messages
 from gtts import gTTS # Google Text-to-Speech for audio output
 from streamlit_mic_recorder import mic_recorder # For audio input
+from transliteration import SCRIPT_LABELS, to_script, to_script_batch, transliterate # Script conversion for display and cache keys
 
 # --- Configuration ---
 st.set_page_config(
@@ -16,6 +42,130 @@ st.set_page_config(
     initial_sidebar_state="auto",
 )
 
+# Gemini client setup happens once per process; model handles are cached per configuration.
+GEMINI_MODEL_NAME = os.environ.get("SANSKRITAI_GEMINI_MODEL", "gemini-1.5-flash")
+GEMINI_TRANSPORT = os.environ.get("SANSKRITAI_GEMINI_TRANSPORT") # "grpc" (library default) or "rest"
+
+log = logging.getLogger("sanskritai")
+
+# Bundled data files (shloka corpus, ...) live next to this script.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# Every upstream call (Gemini requests, file upload/delete) goes through one gateway per process:
+# a token bucket for request rate, a cap on in-flight calls, a round-robin queue across users
+# and jittered exponential retries for retryable errors.
+UPSTREAM_RATE_PER_SECOND = float(os.environ.get("SANSKRITAI_UPSTREAM_RATE", 5.0))
+UPSTREAM_BURST = int(os.environ.get("SANSKRITAI_UPSTREAM_BURST", 10))
+UPSTREAM_MAX_IN_FLIGHT = int(os.environ.get("SANSKRITAI_UPSTREAM_MAX_IN_FLIGHT", 8))
+UPSTREAM_MAX_RETRIES = int(os.environ.get("SANSKRITAI_UPSTREAM_MAX_RETRIES", 4))
+UPSTREAM_BACKOFF_BASE_SECONDS = 0.5
+UPSTREAM_BACKOFF_MAX_SECONDS = 8.0
+UPSTREAM_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("SANSKRITAI_UPSTREAM_QUEUE_TIMEOUT", 60))
+
+# Persona system instructions at or above this size are uploaded once as cached context
+# (the API rejects smaller caches); shorter ones are sent as plain system instructions.
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("SANSKRITAI_CONTEXT_CACHE_MIN_TOKENS", 32768))
+CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get("SANSKRITAI_CONTEXT_CACHE_TTL", 3600))
+
+# Durable per-user state (chat history, learning stats) lives in a local SQLite database.
+STATE_DIR = os.environ.get("SANSKRITAI_STATE_DIR", os.path.join(os.path.expanduser("~"), ".local", "share", "sanskritai"))
+SESSION_DB_PATH = os.environ.get("SANSKRITAI_DB_PATH", os.path.join(STATE_DIR, "sessions.db"))
+SESSION_STORE_BATCH_SIZE = 200
+SESSION_STORE_FLUSH_SECONDS = 0.25
+SESSION_STORE_FLUSH_TIMEOUT = 5.0 # Longest Logout waits for this session's writes to be committed
+# History is only kept for accounts whose password was checked; passwords are stored as salted PBKDF2-SHA256 hashes.
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("SANSKRITAI_PASSWORD_ITERATIONS", 600000))
+
+# Text-to-speech cache: an in-process LRU in front of an MP3 store on disk that
+# every session and every server process shares.
+CACHE_ROOT = os.environ.get("SANSKRITAI_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sanskritai"))
+TTS_CACHE_DIR = os.environ.get("SANSKRITAI_TTS_CACHE_DIR", os.path.join(CACHE_ROOT, "tts"))
+TTS_MEMORY_CACHE_BYTES = int(os.environ.get("SANSKRITAI_TTS_MEMORY_CACHE_BYTES", 32 * 1024 * 1024))
+TTS_DISK_CACHE_BYTES = int(os.environ.get("SANSKRITAI_TTS_DISK_CACHE_BYTES", 512 * 1024 * 1024))
+
+# Chat replies are rendered chunk by chunk as the model produces them.
+STREAM_RESPONSES = os.environ.get("SANSKRITAI_STREAM_RESPONSES", "1") != "0"
+RESPONSE_METRICS_KEPT = 50 # Per-session latency samples kept for the stats panel
+
+# Chat context sent upstream: the persona instruction, a rolling summary of older turns and
+# a window of recent turns, bounded by an estimated token budget.
+CHAT_WINDOW_TURNS = int(os.environ.get("SANSKRITAI_CHAT_WINDOW_TURNS", 8))
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("SANSKRITAI_CHAT_TOKEN_BUDGET", 3000))
+CHAT_SUMMARY_TOKEN_LIMIT = int(os.environ.get("SANSKRITAI_CHAT_SUMMARY_TOKENS", 300))
+
+# Only the newest messages are rendered on each rerun; older ones are paged in on request.
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get("SANSKRITAI_HISTORY_PAGE_SIZE", 20))
+
+# Per-session memory is measured on every rerun. A session over the cap moves the text of
+# messages it isn't showing to a spill file on disk and reloads it when it is shown again;
+# consumed recordings are always spilled.
+SESSION_MEMORY_LIMIT_BYTES = int(os.environ.get("SANSKRITAI_SESSION_MEMORY_BYTES", 4 * 1024 * 1024))
+SPILL_DIR = os.environ.get("SANSKRITAI_SPILL_DIR", os.path.join(CACHE_ROOT, "spill"))
+SPILL_TTL_SECONDS = 24 * 3600 # Spill files of sessions that never logged out are swept after this
+SESSION_IDLE_SECONDS = 30 * 60 # Sessions not seen for this long drop out of the admin view
+ADMIN_USERS = {u.strip().casefold() for u in os.environ.get("SANSKRITAI_ADMIN_USERS", "").split(",") if u.strip()}
+
+# Recorded audio is trimmed, downmixed and resampled before it is sent; small clips go inline
+# with the request instead of through the upload/delete file lifecycle.
+AUDIO_TARGET_RATE = 16000
+AUDIO_SILENCE_THRESHOLD_DB = -40.0 # Frame energy relative to the loudest frame
+AUDIO_SILENCE_PAD_MS = 150
+AUDIO_INLINE_MAX_BYTES = int(os.environ.get("SANSKRITAI_AUDIO_INLINE_MAX_BYTES", 8 * 1024 * 1024))
+
+# Spoken questions are transcribed and answered in a single chat request.
+VOICE_SINGLE_TURN = os.environ.get("SANSKRITAI_VOICE_SINGLE_TURN", "1") != "0"
+
+# Recitation shlokas come from a local corpus; its binary index is built on first use.
+SHLOKA_CORPUS_PATH = os.path.join(DATA_DIR, "shlokas.json")
+SHLOKA_INDEX_PATH = os.environ.get("SANSKRITAI_SHLOKA_INDEX", os.path.join(CACHE_ROOT, "shlokas.idx"))
+SHLOKA_MAX_SYLLABLES = {1: 32, 2: 44} # Longest shloka offered per difficulty (one anuṣṭubh, one triṣṭubh verse); Hard has no cap
+
+# Recitations are scored on this machine: MFCC features of the recording are aligned with DTW
+# against the cached TTS rendering of the shloka. The model only words the feedback from the
+# scores, and is skipped entirely in quick practice.
+PRONUNCIATION_FRAME_MS = 25
+PRONUNCIATION_HOP_MS = 10
+PRONUNCIATION_MFCC_COUNT = 13
+PRONUNCIATION_MEL_BANDS = 40
+PRONUNCIATION_MAX_DTW_CELLS = 4_000_000 # Longer pairs are aligned on decimated frames
+# Mean cosine distance along the path that scores 100 and 0. Other voices reading the right text
+# land around 0.2-0.4 from the reference; a different text around 0.5-0.6.
+PRONUNCIATION_GOOD_DISTANCE = 0.30
+PRONUNCIATION_BAD_DISTANCE = 0.60
+RECITATION_PASS_SCORE = int(os.environ.get("SANSKRITAI_RECITATION_PASS_SCORE", 60)) # Lower counts as a miss for review
+
+# Replies to self-contained questions (definitions, translations) are shared across users
+# per persona for a limited time.
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("SANSKRITAI_RESPONSE_CACHE_ENTRIES", 5000))
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get("SANSKRITAI_RESPONSE_CACHE_TTL", 24 * 3600))
+
+# Pure "what does X mean?" questions to these personas are answered from a local lexicon when X,
+# an inflected form of it or a compound of its headwords is listed; everything else goes to the
+# model. The lexicon's binary index is built on first use, like the shloka index.
+LEXICON_PATH = os.path.join(DATA_DIR, "lexicon.json")
+LEXICON_INDEX_PATH = os.environ.get("SANSKRITAI_LEXICON_INDEX", os.path.join(CACHE_ROOT, "lexicon.idx"))
+LEXICON_PERSONAS = ("General", "Grammar (Pāṇini AI)")
+
+# Quiz questions are generated in batches per (persona, difficulty) and served from memory.
+QUIZ_DIFFICULTIES = ["Easy", "Medium", "Hard"]
+QUIZ_POOL_BATCH_SIZE = int(os.environ.get("SANSKRITAI_QUIZ_BATCH_SIZE", 10))
+QUIZ_POOL_LOW_WATER = int(os.environ.get("SANSKRITAI_QUIZ_LOW_WATER", 3))
+
+# Slow work (speech synthesis, quiz and shloka generation, transcription) runs on a per-process
+# worker pool while the page polls for it, so no rerun blocks on it. Every new reply is also
+# synthesized speculatively, so its Play Audio button is usually served from the audio cache.
+BACKGROUND_WORKERS = int(os.environ.get("SANSKRITAI_BACKGROUND_WORKERS", 8))
+BACKGROUND_POLL_SECONDS = 0.5
+SPECULATIVE_TTS = os.environ.get("SANSKRITAI_SPECULATIVE_TTS", "1") != "0"
+
+# Every upstream call, speech synthesis and page rerun is timed and counted, labeled by persona
+# and feature. The metrics are served in the Prometheus text format at
+# http://METRICS_HOST:METRICS_PORT/metrics (port 0 turns the endpoint off) and summarized for admins.
+METRICS_HOST = os.environ.get("SANSKRITAI_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("SANSKRITAI_METRICS_PORT", 9464))
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # Seconds
+METRICS_SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(9)) # 256 B to 16 MB
+
 # --- Enhanced Custom CSS for Modern Interactive Design ---
 def load_css():
     """Injects custom CSS for a modern, interactive look with animations."""
@@ -231,19 +381,2469 @@ def load_css():
         </style>
     """, unsafe_allow_html=True)
 
+# --- Persona Definitions ---
+PERSONAS = {
+    "General": "You are 'SanskritAI', a helpful and encouraging AI tutor for the Sanskrit language.",
+    "Grammar (Pāṇini AI)": "You are Pāṇini AI, an expert in Sanskrit grammar based on the Aṣṭādhyāyī. Explain concepts with precision and cite sutras where possible.",
+    "Ayurveda (Charak AI)": "You are Charak AI, an expert on Ayurveda based on the Charaka Samhita. Answer questions about health, herbs, and principles, citing your source text.",
+    "Literature (Vyasa AI)": "You are Vyasa AI, a master of Sanskrit literature like the Mahabharata and Puranas. Recount stories and explain literary concepts, citing the epic you are referencing."
+}
+
+PERSONA_GUIDANCE = {
+    "General": (
+        "Adapt to the learner's level: start simple, then add detail when asked. When you give a Sanskrit word, "
+        "show it in Devanagari followed by IAST in parentheses and a short English gloss. Prefer small, concrete "
+        "examples over long lists, and end longer answers with one suggestion for what to practise next."
+    ),
+    "Grammar (Pāṇini AI)": (
+        "Cite Aṣṭādhyāyī sūtras by adhyāya.pāda.sūtra number (e.g. 6.1.77 iko yaṇ aci) and quote the sūtra in "
+        "Devanagari and IAST. When deriving a form, list each step with the sūtra applied. Distinguish Pāṇinian "
+        "terminology (saṃjñā, paribhāṣā, vidhi) from modern descriptive grammar, and say when a point is debated "
+        "by the commentators (Kāśikā, Siddhāntakaumudī)."
+    ),
+    "Ayurveda (Charak AI)": (
+        "Cite the Caraka Saṃhitā by sthāna, adhyāya and verse (e.g. Sūtrasthāna 1.41) and name other classical "
+        "sources (Suśruta Saṃhitā, Aṣṭāṅga Hṛdaya) when you draw on them. Explain concepts through the doṣas, "
+        "dhātus and agni. Never give a diagnosis or dosage; remind the learner to consult a qualified practitioner "
+        "for any health decision."
+    ),
+    "Literature (Vyasa AI)": (
+        "Cite the Mahābhārata by parvan and adhyāya, the Rāmāyaṇa by kāṇḍa and sarga, and Purāṇas by name and "
+        "chapter. Quote short key verses in Devanagari with IAST and a translation. Keep retellings faithful to the "
+        "text and mark where regional or later versions differ."
+    ),
+}
+
+CITATION_GUIDANCE = (
+    "Only cite passages you are confident exist. If you are unsure of an exact reference, say so instead of "
+    "inventing one."
+)
+
+def persona_system_instruction(persona):
+    """Full system instruction for ``persona``: its description, its guidance and the shared citation rules."""
+    return "\n\n".join([PERSONAS[persona], PERSONA_GUIDANCE.get(persona, ""), CITATION_GUIDANCE]).strip()
+
+# --- Metrics ---
+DEFAULT_METRIC_LABELS = {"persona": "none", "feature": "other"}
+
+def request_bytes(value):
+    """Approximate upload size of request arguments: text as UTF-8, inline audio, file buffers and nested contents."""
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, io.BytesIO):
+        return value.getbuffer().nbytes
+    if isinstance(value, dict):
+        return sum(request_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(request_bytes(v) for v in value)
+    return 0
+
+def response_bytes(response):
+    """UTF-8 size of a response's (or stream chunk's) text; 0 for responses without text parts."""
+    try:
+        return len(response.text.encode("utf-8"))
+    except Exception:
+        return 0
+
+class MetricsRegistry:
+    """Process-wide counters and histograms, labeled with the persona and feature in effect (see labeled()).
+
+    Metrics registered with a ``read`` function have one unlabeled series whose value is read when scraped.
+    """
+
+    def __init__(self):
+        self._metrics = {} # name -> (type, help, buckets)
+        self._series = {} # (name, labels) -> count, or [bucket counts, sum] for histograms
+        self._readers = {} # name -> read() for metrics sampled at scrape time
+        self._context = contextvars.ContextVar("metric_labels", default={})
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def labeled(self, **labels):
+        """Adds ``labels`` to everything recorded in the block, including by background jobs submitted from it."""
+        token = self._context.set({**self._context.get(), **labels})
+        try:
+            yield
+        finally:
+            self._context.reset(token)
+
+    def counter(self, name, help_text, read=None):
+        self._metrics[name] = ("counter", help_text, None)
+        if read is not None:
+            self._readers[name] = read
+
+    def gauge(self, name, help_text, read):
+        self._metrics[name] = ("gauge", help_text, None)
+        self._readers[name] = read
+
+    def histogram(self, name, help_text, buckets):
+        self._metrics[name] = ("histogram", help_text, tuple(buckets))
+
+    def _labels(self, labels):
+        return tuple(sorted({**DEFAULT_METRIC_LABELS, **self._context.get(), **labels}.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        buckets = self._metrics[name][2]
+        key = (name, self._labels(labels))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(buckets, value)] += 1
+            series[1] += value
+
+    def _snapshot(self):
+        with self._lock:
+            series = [(key, [list(v[0]), v[1]] if isinstance(v, list) else v) for key, v in self._series.items()]
+        for name, read in list(self._readers.items()):
+            try:
+                series.append(((name, ()), read()))
+            except Exception:
+                pass # A broken reader must not break the scrape
+        return sorted(series)
+
+    def render(self):
+        """The registry in the Prometheus text exposition format (version 0.0.4)."""
+        def fmt(labels):
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+        snapshot = self._snapshot()
+        lines = []
+        for name, (kind, help_text, buckets) in self._metrics.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for (series_name, labels), value in snapshot:
+                if series_name != name:
+                    continue
+                if kind != "histogram":
+                    lines.append(f"{name}{fmt(labels) if labels else ''} {value}")
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip([*buckets, "+Inf"], counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{fmt(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{fmt(labels)} {total}")
+                lines.append(f"{name}_count{fmt(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """One row per series for the admin panel: counters and gauges with their value, histograms with count, mean, p50 and p95."""
+        rows = []
+        for (name, labels), value in self._snapshot():
+            kind, _, buckets = self._metrics[name]
+            row = {"metric": name, "kind": kind, "labels": dict(labels)}
+            if kind != "histogram":
+                row["value"] = value
+            else:
+                counts, total = value
+                count = sum(counts)
+                row.update(count=count, mean=total / count if count else 0.0,
+                           p50=self._quantile(buckets, counts, 0.50), p95=self._quantile(buckets, counts, 0.95))
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def _quantile(buckets, counts, q):
+        """Estimates a quantile by interpolating linearly inside the bucket it falls in."""
+        rank = q * sum(counts)
+        cumulative, lower = 0, 0.0
+        for bound, count in zip(buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return buckets[-1] # Beyond the largest bucket: report its bound
+
+@st.cache_resource
+def get_metrics_registry():
+    """Returns the process-wide metrics registry with every metric the app records."""
+    registry = MetricsRegistry()
+    registry.histogram("sanskritai_upstream_request_seconds", "Duration of each Gemini API call attempt.", METRICS_LATENCY_BUCKETS)
+    registry.counter("sanskritai_upstream_requests_total", "Gemini API call attempts by outcome (ok or the error class).")
+    registry.histogram("sanskritai_upstream_request_bytes", "Approximate size of the text and media sent per call.", METRICS_SIZE_BUCKETS)
+    registry.histogram("sanskritai_upstream_response_bytes", "Size of the text returned per call.", METRICS_SIZE_BUCKETS)
+    registry.counter("sanskritai_upstream_tokens_total", "Tokens reported by the API, by kind (prompt or reply).")
+    registry.histogram("sanskritai_tts_seconds", "Duration of each gTTS synthesis.", METRICS_LATENCY_BUCKETS)
+    registry.histogram("sanskritai_tts_bytes", "Size of each synthesized MP3.", METRICS_SIZE_BUCKETS)
+    registry.counter("sanskritai_tts_requests_total", "gTTS syntheses by outcome (ok or the error class).")
+    registry.histogram("sanskritai_rerun_seconds", "Duration of each full rerun of a page.", METRICS_LATENCY_BUCKETS)
+    registry.counter("sanskritai_reruns_total", "Page reruns by how they ended (ok, RerunException, StopException or an error class).")
+    registry.counter("sanskritai_replies_total", "Chat replies by source (model, cache or lexicon).")
+    registry.histogram("sanskritai_upstream_queue_wait_seconds", "Time each Gemini API call waited for admission.", METRICS_LATENCY_BUCKETS)
+    return registry
+
+def export_stats(metrics, prefix, stats, fields):
+    """Publishes fields of a component's ``stats()`` as ``prefix_<field>`` metrics, read at scrape time.
+
+    ``fields`` maps each field to (kind, help text); counters get the conventional ``_total`` suffix.
+    """
+    for field, (kind, help_text) in fields.items():
+        read = lambda field=field: stats()[field]
+        if kind == "counter":
+            metrics.counter(f"{prefix}_{field}_total", help_text, read)
+        else:
+            metrics.gauge(f"{prefix}_{field}", help_text, read)
+
+@st.cache_resource
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serves the registry at http://host:port/metrics from a daemon thread; returns None when disabled or the port is taken."""
+    if not port:
+        return None
+    registry = get_metrics_registry()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass # Scrapes would otherwise be logged to stderr one line each
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError:
+        return None # Another server process already exports on this port
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+def metric_labels(**labels):
+    """Labels the metrics recorded in a ``with`` block or decorated function; see MetricsRegistry.labeled."""
+    return get_metrics_registry().labeled(**labels)
+
+def instrumented_rerun(page):
+    """Runs ``page`` under the session's persona label and records how long the rerun took and how it ended."""
+    metrics = get_metrics_registry()
+    with metrics.labeled(persona=st.session_state.get("ai_persona", "none")):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            page()
+        except BaseException as e: # st.rerun() and st.stop() end a run by raising
+            outcome = type(e).__name__
+            raise
+        finally:
+            metrics.observe("sanskritai_rerun_seconds", time.perf_counter() - started, page=page.__name__)
+            metrics.inc("sanskritai_reruns_total", page=page.__name__, outcome=outcome)
+
+# --- Upstream Gateway ---
+RETRYABLE_UPSTREAM_ERRORS = (
+    google_exceptions.TooManyRequests, # Includes ResourceExhausted (429)
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+)
+
+class UpstreamGateway:
+    """Shared admission control for Gemini calls: per-user round-robin, an in-flight cap and a token bucket.
+
+    Retryable errors back off with full jitter and queue again; every attempt is recorded in ``metrics``.
+    """
+
+    def __init__(self, rate_per_second, burst, max_in_flight, max_retries=UPSTREAM_MAX_RETRIES,
+                 queue_timeout=UPSTREAM_QUEUE_TIMEOUT_SECONDS, metrics=None):
+        self.metrics = metrics
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._in_flight = 0
+        self._waiting = OrderedDict() # user key -> deque of tickets, in round-robin order
+        self._waits = deque(maxlen=1000)
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate_per_second)
+        self._refilled_at = now
+
+    def _acquire(self, user_key):
+        ticket = object()
+        enqueued_at = time.monotonic()
+        with self._cond:
+            self._waiting.setdefault(user_key, deque()).append(ticket)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                head_user = next(iter(self._waiting))
+                is_next = head_user == user_key and self._waiting[user_key][0] is ticket
+                if is_next and self._in_flight < self.max_in_flight and self._tokens >= 1:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    tickets = self._waiting[user_key]
+                    tickets.popleft()
+                    if tickets:
+                        self._waiting.move_to_end(user_key) # Next call from this user waits its turn
+                    else:
+                        del self._waiting[user_key]
+                    self._waits.append(now - enqueued_at)
+                    if self.metrics is not None:
+                        self.metrics.observe("sanskritai_upstream_queue_wait_seconds", now - enqueued_at)
+                    self._cond.notify_all()
+                    return
+                remaining = enqueued_at + self.queue_timeout - now
+                if remaining <= 0:
+                    tickets = self._waiting[user_key]
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del self._waiting[user_key]
+                    self.timeouts += 1
+                    self._cond.notify_all()
+                    raise TimeoutError("The AI service is busy right now. Please try again in a moment.")
+                if is_next and self._in_flight < self.max_in_flight:
+                    # Only the token bucket is in the way: sleep until the next token is due
+                    self._cond.wait(min(remaining, (1 - self._tokens) / self.rate_per_second))
+                else:
+                    self._cond.wait(remaining)
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _backoff(self, attempt):
+        with self._cond:
+            self.retries += 1
+        time.sleep(random.uniform(0, min(UPSTREAM_BACKOFF_MAX_SECONDS, UPSTREAM_BACKOFF_BASE_SECONDS * 2 ** attempt)))
+
+    def _observe(self, operation, started, args, received=0, usage=None, error=None):
+        if self.metrics is None:
+            return
+        self.metrics.observe("sanskritai_upstream_request_seconds", time.perf_counter() - started, operation=operation)
+        self.metrics.inc("sanskritai_upstream_requests_total", operation=operation, outcome=type(error).__name__ if error else "ok")
+        self.metrics.observe("sanskritai_upstream_request_bytes", request_bytes(args), operation=operation)
+        if error is None:
+            self.metrics.observe("sanskritai_upstream_response_bytes", received, operation=operation)
+        for kind, field in (("prompt", "prompt_token_count"), ("reply", "candidates_token_count")):
+            tokens = getattr(usage, field, None) if usage is not None else None
+            if tokens:
+                self.metrics.inc("sanskritai_upstream_tokens_total", tokens, operation=operation, kind=kind)
+
+    def call(self, user_key, fn, *args, **kwargs):
+        """Runs ``fn(*args, **kwargs)`` under admission control and returns its result."""
+        operation = getattr(fn, "__name__", "call")
+        for attempt in range(self.max_retries + 1):
+            self._acquire(user_key)
+            started = time.perf_counter()
+            try:
+                with self._cond:
+                    self.calls += 1
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self._observe(operation, started, args, error=e)
+                if not isinstance(e, RETRYABLE_UPSTREAM_ERRORS):
+                    raise
+                if attempt == self.max_retries:
+                    with self._cond:
+                        self.failures += 1
+                    raise
+            else:
+                self._observe(operation, started, args, response_bytes(result), getattr(result, "usage_metadata", None))
+                return result
+            finally:
+                self._release()
+            self._backoff(attempt)
+
+    def stream(self, user_key, fn, *args, **kwargs):
+        """Like call() for a streaming ``fn``: yields its chunks and holds the slot until the stream ends.
+
+        A retryable error is only retried if it happens before the first chunk.
+        """
+        operation = getattr(fn, "__name__", "call")
+        for attempt in range(self.max_retries + 1):
+            self._acquire(user_key)
+            started = time.perf_counter()
+            yielded = False
+            received, usage = 0, None
+            try:
+                with self._cond:
+                    self.calls += 1
+                for chunk in fn(*args, **kwargs):
+                    yielded = True
+                    received += response_bytes(chunk)
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    yield chunk
+            except Exception as e:
+                self._observe(operation, started, args, error=e)
+                if not isinstance(e, RETRYABLE_UPSTREAM_ERRORS):
+                    raise
+                if yielded or attempt == self.max_retries:
+                    with self._cond:
+                        self.failures += 1
+                    raise
+            else:
+                self._observe(operation, started, args, received, usage)
+                return
+            finally:
+                self._release()
+            self._backoff(attempt)
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            def percentile(p):
+                return waits[min(len(waits) - 1, int(p * len(waits)))] * 1000 if waits else 0.0
+            return {
+                "queue_depth": sum(len(t) for t in self._waiting.values()),
+                "waiting_users": len(self._waiting),
+                "in_flight": self._in_flight,
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "timeouts": self.timeouts,
+                "wait_p50_ms": percentile(0.50),
+                "wait_p95_ms": percentile(0.95),
+                "wait_max_ms": waits[-1] * 1000 if waits else 0.0,
+            }
+
+@st.cache_resource
+def get_upstream_gateway():
+    """Returns the process-wide upstream gateway, with its queue exported to the metrics registry."""
+    metrics = get_metrics_registry()
+    gateway = UpstreamGateway(UPSTREAM_RATE_PER_SECOND, UPSTREAM_BURST, UPSTREAM_MAX_IN_FLIGHT, metrics=metrics)
+    export_stats(metrics, "sanskritai_upstream", gateway.stats, {
+        "queue_depth": ("gauge", "Gemini API calls waiting for admission."),
+        "waiting_users": ("gauge", "Users with at least one call waiting for admission."),
+        "in_flight": ("gauge", "Gemini API calls running now."),
+        "calls": ("counter", "Gemini API calls made through the gateway."),
+        "retries": ("counter", "Retries after retryable Gemini API errors."),
+        "failures": ("counter", "Gemini API calls that failed after all retries."),
+        "timeouts": ("counter", "Gemini API calls that gave up waiting for admission."),
+    })
+    return gateway
+
+SYSTEM_UPSTREAM_KEY = "__system__" # Background work (quiz refills, context caches) queues as one more "user"
+
+def session_id():
+    """Random id of the current browser session, created on first use."""
+    if "session_key" not in st.session_state:
+        st.session_state.session_key = uuid.uuid4().hex
+    return st.session_state.session_key
+
+def session_user_key():
+    """Fairness key for the current session: the logged-in user, or a random per-session id."""
+    if st.session_state.get("user_id"):
+        return st.session_state.user_id
+    return session_id()
+
+def call_upstream(fn, *args, **kwargs):
+    """Runs an upstream call for the current session through the shared gateway."""
+    return get_upstream_gateway().call(session_user_key(), fn, *args, **kwargs)
+
+# --- Gemini Client Registry ---
+class ModelRegistry:
+    """Configures the Gemini client once and hands out shared GenerativeModel handles.
+
+    ``genai.configure`` discards the library's cached API clients, so calling it on
+    every rerun also throws away their warm connections. The registry calls it once
+    and keeps one model handle per (model name, configuration), all backed by the
+    same long-lived client.
+    """
+
+    def __init__(self, api_key, transport=None, gateway=None):
+        self.gateway = gateway
+        options = {"api_key": api_key}
+        if transport:
+            options["transport"] = transport
+        genai.configure(**options)
+        self._models = {}
+        self._cached_contexts = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name=GEMINI_MODEL_NAME, **config):
+        """Returns the shared model handle for ``model_name`` built with ``config`` (e.g. generation_config)."""
+        key = (model_name, json.dumps(config, sort_keys=True, default=str))
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = genai.GenerativeModel(model_name, **config)
+                self._models[key] = model
+            return model
+
+    def with_system_instruction(self, instruction, model_name=GEMINI_MODEL_NAME):
+        """Returns a model handle carrying ``instruction`` as its system instruction.
+
+        Instructions large enough for the API's context cache are uploaded once and
+        shared until shortly before the cache expires, so they are not re-sent (or
+        re-billed at the full rate) on every turn. Anything else, or a failed cache
+        creation, falls back to a plain system instruction.
+        """
+        key = (model_name, instruction)
+        with self._lock:
+            entry = self._cached_contexts.get(key)
+            if entry is not None and entry[1] > time.time():
+                return entry[0]
+        if estimate_tokens(instruction) >= CONTEXT_CACHE_MIN_TOKENS:
+            try:
+                create = genai.caching.CachedContent.create
+                if self.gateway is not None:
+                    create = lambda **kwargs: self.gateway.call(SYSTEM_UPSTREAM_KEY, genai.caching.CachedContent.create, **kwargs)
+                cached = create(
+                    model=model_name,
+                    system_instruction=instruction,
+                    ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS),
+                )
+                model = genai.GenerativeModel.from_cached_content(cached)
+                with self._lock:
+                    self._cached_contexts[key] = (model, time.time() + CONTEXT_CACHE_TTL_SECONDS - 60)
+                return model
+            except Exception:
+                pass # Fall back to sending the instruction with each request
+        return self.get(model_name, system_instruction=instruction)
+
+    def prewarm(self, instructions):
+        """Builds the model handles (and context caches) for ``instructions`` ahead of the first request."""
+        for instruction in instructions:
+            try:
+                self.with_system_instruction(instruction)
+            except Exception:
+                pass # Built lazily on first use instead
+
+@st.cache_resource
+def get_model_registry(api_key):
+    """Returns the process-wide model registry for ``api_key``, with persona models warming in the background."""
+    registry = ModelRegistry(api_key, GEMINI_TRANSPORT, get_upstream_gateway())
+    instructions = [persona_system_instruction(persona) for persona in PERSONAS]
+    threading.Thread(target=registry.prewarm, args=(instructions,), daemon=True).start()
+    return registry
+
+# --- Chat Context ---
+def estimate_tokens(text):
+    """Cheap local token estimate: ~4 characters per token for ASCII, ~2 for Devanagari and other scripts."""
+    ascii_chars = sum(1 for ch in text if ch < "\x80")
+    return max(1, (ascii_chars + 3) // 4 + (len(text) - ascii_chars + 1) // 2)
+
+VOICE_TURN_PROMPT = (
+    "The attached recording is the user's next message, spoken aloud. Transcribe it exactly, "
+    "in the language and script that was spoken, then reply to it as you would to a typed message. "
+    'Respond with JSON containing "transcript" and "answer".'
+)
+VOICE_TURN_SCHEMA = {
+    "type": "object",
+    "properties": {"transcript": {"type": "string"}, "answer": {"type": "string"}},
+    "required": ["transcript", "answer"],
+}
+
+ChatMessage = namedtuple("ChatMessage", "id role text tokens") # ``text`` is a SpillRef once spilled to disk
+
+def message_bytes(message):
+    """Approximate resident bytes of a ChatMessage and its text (or spill reference).
+
+    Non-ASCII text also counts the UTF-8 copy CPython caches on it once it is stored,
+    measured on a fresh copy so the result doesn't depend on whether that happened yet.
+    """
+    text = message.text
+    if not isinstance(text, str) or text.isascii():
+        return sys.getsizeof(message) + sys.getsizeof(text)
+    encoded = text.encode("utf-8")
+    return sys.getsizeof(message) + sys.getsizeof(encoded.decode("utf-8")) + len(encoded) + 1
+
+class ChatContext:
+    """Bounded conversation state for one persona chat: only a rolling summary and the newest turns go upstream.
+
+    ``on_turn(user_message, model_message, summary)`` runs after every turn; ``summary`` is None unless it changed.
+    """
+
+    def __init__(self, model, greeting, history=(), summary="", has_earlier=False, on_turn=None,
+                 window_turns=CHAT_WINDOW_TURNS, token_budget=CHAT_CONTEXT_TOKEN_BUDGET):
+        self.model = model
+        self.greeting = greeting
+        self.window_turns = window_turns
+        self.token_budget = token_budget
+        self.summary = summary
+        self.has_earlier = has_earlier
+        self.on_turn = on_turn
+        self.gateway = None # Set by the page on each rerun, like ``model``
+        self.user_key = None
+        self.turns = [] # (user message, model message) pairs still sent verbatim
+        if history:
+            self.transcript = [ChatMessage(m["id"], m["role"], m["text"], estimate_tokens(m["text"])) for m in history]
+            self._next_id = max(m["id"] for m in history) + 1
+            pending = None
+            for message in self.transcript:
+                if message.role == "user":
+                    pending = message
+                elif pending is not None:
+                    self.turns.append((pending, message))
+                    pending = None
+            self.turns = self.turns[-self.window_turns:]
+        else:
+            self._next_id = 0
+            self.transcript = [self._message("model", greeting)]
+        self.resident_bytes = sum(map(message_bytes, self.transcript)) # Kept current so measuring a session needn't walk it
+
+    def prepend_history(self, messages, has_earlier):
+        """Adds an older page of stored messages in front of the transcript."""
+        page = [ChatMessage(m["id"], m["role"], m["text"], estimate_tokens(m["text"])) for m in messages]
+        self.transcript[:0] = page
+        self.resident_bytes += sum(map(message_bytes, page))
+        self.has_earlier = has_earlier
+
+    def _message(self, role, text, tokens=None):
+        message = ChatMessage(self._next_id, sys.intern(role), text, tokens or estimate_tokens(text))
+        self._next_id += 1
+        return message
+
+    def spill(self, store, session, keep=0):
+        """Moves the text of all but the newest ``keep`` messages to ``store``, except turns still in the context window.
+
+        Returns the number of messages spilled.
+        """
+        pinned = {message.id for pair in self.turns for message in pair}
+        positions = [
+            i for i, message in enumerate(self.transcript[:max(0, len(self.transcript) - keep)])
+            if isinstance(message.text, str) and message.id not in pinned
+        ]
+        refs = store.put_many(session, [self.transcript[i].text.encode("utf-8") for i in positions])
+        for i, ref in zip(positions, refs):
+            spilled = self.transcript[i]._replace(text=ref)
+            self.resident_bytes += message_bytes(spilled) - message_bytes(self.transcript[i])
+            self.transcript[i] = spilled
+        return len(positions)
+
+    def context_tokens(self):
+        """Estimated tokens of everything sent upstream besides the new user message."""
+        total = estimate_tokens(self.summary) if self.summary else 0
+        return total + sum(u.tokens + m.tokens for u, m in self.turns)
+
+    def build_contents(self, user_parts):
+        contents = []
+        if self.summary:
+            contents.append({'role': 'user', 'parts': [f"Summary of our conversation so far: {self.summary}"]})
+            contents.append({'role': 'model', 'parts': ["Understood, I will keep that in mind."]})
+        for user_message, model_message in self.turns:
+            contents.append({'role': 'user', 'parts': [user_message.text]})
+            contents.append({'role': 'model', 'parts': [model_message.text]})
+        contents.append({'role': 'user', 'parts': user_parts if isinstance(user_parts, list) else [user_parts]})
+        return contents
+
+    def _generate(self, *args, **kwargs):
+        if self.gateway is None:
+            return self.model.generate_content(*args, **kwargs)
+        return self.gateway.call(self.user_key, self.model.generate_content, *args, **kwargs)
+
+    def send_message(self, text, stream=False):
+        """Sends ``text`` with the bounded context. Returns the reply text, or a generator of chunks when streaming."""
+        contents = self.build_contents(text)
+        if stream:
+            return self._stream(text, contents)
+        response = self._generate(contents)
+        reply = response.text
+        if not reply.strip():
+            raise ValueError("The model returned an empty reply.")
+        self.record_turn(text, reply, getattr(response, "usage_metadata", None))
+        return reply
+
+    def _stream(self, text, contents):
+        if self.gateway is None:
+            chunks = self.model.generate_content(contents, stream=True)
+        else:
+            chunks = self.gateway.stream(self.user_key, self.model.generate_content, contents, stream=True)
+        pieces = []
+        usage = None
+        for chunk in chunks:
+            usage = getattr(chunk, "usage_metadata", None) or usage # The last chunk carries the final counts
+            try:
+                piece = chunk.text
+            except ValueError:
+                continue # Chunk without text parts (e.g. only safety metadata)
+            pieces.append(piece)
+            yield piece
+        reply = "".join(pieces)
+        if not reply.strip(): # Every chunk was blocked or empty: nothing to record or cache
+            raise ValueError("The model returned an empty reply.")
+        self.record_turn(text, reply, usage)
+
+    def send_voice(self, recording):
+        """Answers a spoken question in one request and returns (transcript, reply).
+
+        The transcript, not the audio, is recorded as the user turn, so later requests
+        carry plain text like any typed message.
+        """
+        transcript, reply = self.answer_voice(recording)
+        self.record_turn(transcript, reply)
+        return transcript, reply
+
+    def answer_voice(self, recording):
+        """Like send_voice, but leaves recording the turn to the caller (for background jobs)."""
+        contents = self.build_contents([VOICE_TURN_PROMPT, recording])
+        response = self._generate(
+            contents,
+            generation_config={"response_mime_type": "application/json", "response_schema": VOICE_TURN_SCHEMA},
+        )
+        result = json.loads(response.text)
+        transcript = str(result.get("transcript", "")).strip()
+        reply = str(result.get("answer", "")).strip()
+        if not transcript or not reply:
+            raise ValueError("The model returned an incomplete voice reply.")
+        return transcript, reply
+
+    def record_turn(self, user_text, reply_text, usage=None):
+        """Appends a completed turn, using the reported reply token count when the API returns one."""
+        reply_tokens = getattr(usage, "candidates_token_count", None) if usage is not None else None
+        user_message = self._message("user", user_text)
+        model_message = self._message("model", reply_text, reply_tokens)
+        self.transcript += [user_message, model_message]
+        self.resident_bytes += message_bytes(user_message) + message_bytes(model_message)
+        self.turns.append((user_message, model_message))
+        summary_changed = self._compact()
+        if self.on_turn is not None:
+            self.on_turn(user_message, model_message, self.summary if summary_changed else None)
+
+    def _compact(self):
+        """Folds old turns into the summary when the window is over budget. Returns True if the summary changed."""
+        if len(self.turns) <= self.window_turns and self.context_tokens() <= self.token_budget:
+            return False
+        # Keep the newest half of the window (fewer if still over budget) and fold the rest in one call
+        keep = max(1, self.window_turns // 2)
+        folded, self.turns = self.turns[:-keep], self.turns[-keep:]
+        while len(self.turns) > 1 and self.context_tokens() > self.token_budget:
+            folded.append(self.turns.pop(0))
+        if not folded:
+            return False
+        self.summary = self._summarize(folded)
+        return True
+
+    def _summarize(self, folded):
+        lines = [f"{'User' if m.role == 'user' else 'Tutor'}: {m.text}" for pair in folded for m in pair]
+        prompt = (
+            f"Update this running summary of a Sanskrit tutoring conversation in at most {CHAT_SUMMARY_TOKEN_LIMIT // 2} words. "
+            "Keep names, Sanskrit terms and anything the learner said about themselves.\n\n"
+            f"Current summary: {self.summary or '(none)'}\n\nNew turns:\n" + "\n".join(lines)
+        )
+        try:
+            summary = self._generate(prompt).text.strip()
+        except Exception:
+            # Keep the conversation going without the model: append the clipped user questions instead
+            summary = " ".join([self.summary] + [f"Earlier the user asked: {u.text[:160]}" for u, _ in folded]).strip()
+        max_chars = CHAT_SUMMARY_TOKEN_LIMIT * 4
+        return summary if len(summary) <= max_chars else summary[-max_chars:]
+
+# --- Session Store ---
+SESSION_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    persona TEXT NOT NULL,
+    role TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_user ON messages (user_id, persona, id);
+CREATE TABLE IF NOT EXISTS stats (
+    user_id TEXT PRIMARY KEY,
+    messages_sent INTEGER NOT NULL DEFAULT 0,
+    total_questions INTEGER NOT NULL DEFAULT 0,
+    correct_answers INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS summaries (
+    user_id TEXT NOT NULL,
+    persona TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    PRIMARY KEY (user_id, persona)
+);
+CREATE TABLE IF NOT EXISTS accounts (
+    user_id TEXT PRIMARY KEY,
+    salt BLOB NOT NULL,
+    password_hash BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+SESSION_STORE_WRITES = {
+    "message": "INSERT INTO messages (user_id, persona, role, text, created_at) VALUES (?, ?, ?, ?, ?)",
+    "stats": (
+        "INSERT INTO stats (user_id, messages_sent, total_questions, correct_answers) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET messages_sent = messages_sent + excluded.messages_sent, "
+        "total_questions = total_questions + excluded.total_questions, correct_answers = correct_answers + excluded.correct_answers"
+    ),
+    "summary": "INSERT INTO summaries (user_id, persona, summary) VALUES (?, ?, ?) ON CONFLICT(user_id, persona) DO UPDATE SET summary = excluded.summary",
+}
+
+UNKNOWN_ACCOUNT_SALT = b"sanskritai-none!" # Fixed 16-byte salt for checks against ids that have no account
+
+def hash_password(password, salt):
+    """PBKDF2-SHA256 of ``password``; deliberately slow so a copied database is expensive to brute-force."""
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PASSWORD_HASH_ITERATIONS)
+
+class SessionStore:
+    """Durable chat history and learning stats in SQLite (WAL mode).
+
+    Messages are an append-only log indexed by (user, persona, id). Writes are
+    queued and committed off the request path by one writer thread, in batches of
+    up to ``batch_size`` operations or every ``flush_seconds``. Reads go through a
+    separate connection, which WAL lets run alongside the writer, and only ever
+    fetch one page, so their cost doesn't grow with a user's total history.
+    """
+
+    def __init__(self, path, batch_size=SESSION_STORE_BATCH_SIZE, flush_seconds=SESSION_STORE_FLUSH_SECONDS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue = queue.Queue()
+        self.failed_batches = 0
+        self.dropped_writes = 0
+        self.last_error = None
+        self._read_lock = threading.Lock()
+        self._reader = self._connect()
+        self._reader.executescript(SESSION_STORE_SCHEMA)
+        threading.Thread(target=self._write_loop, name="session-store-writer", daemon=True).start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _commit(self, conn, batch):
+        for attempt in range(3):
+            try:
+                with conn: # One transaction per batch
+                    for kind, params in batch:
+                        conn.execute(SESSION_STORE_WRITES[kind], params)
+                return
+            except sqlite3.OperationalError:
+                if attempt == 2:
+                    raise
+                time.sleep(0.1 * (attempt + 1)) # Locked by another process; retry the whole batch
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._commit(conn, batch)
+            except Exception:
+                log.exception("Session store batch of %d writes failed; retrying them one at a time", len(batch))
+                self.failed_batches += 1
+                for write in batch: # Only the writes that fail on their own are lost
+                    try:
+                        self._commit(conn, [write])
+                    except Exception as e:
+                        log.exception("Dropped a session store %s write", write[0])
+                        self.dropped_writes += 1
+                        self.last_error = f"{type(e).__name__}: {e}"
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def append_message(self, user_id, persona, role, text):
+        self._queue.put(("message", (user_id, persona, role, text, time.time())))
+
+    def add_stats(self, user_id, messages_sent=0, total_questions=0, correct_answers=0):
+        self._queue.put(("stats", (user_id, messages_sent, total_questions, correct_answers)))
+
+    def save_summary(self, user_id, persona, summary):
+        self._queue.put(("summary", (user_id, persona, summary)))
+
+    def flush(self, timeout=SESSION_STORE_FLUSH_TIMEOUT):
+        """Waits up to ``timeout`` seconds for every queued write to be committed; returns whether they were."""
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def pending_writes(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            "pending_writes": self.pending_writes(),
+            "failed_batches": self.failed_batches,
+            "dropped_writes": self.dropped_writes,
+            "last_error": self.last_error,
+        }
+
+    def create_account(self, user_id, password):
+        """Registers ``user_id`` with a salted hash of ``password``; returns False if the id is already taken.
+
+        Written synchronously, since signup has to know at once whether it worked. History
+        left under the id from before it had an account is cleared rather than handed over.
+        """
+        salt = os.urandom(16)
+        password_hash = hash_password(password, salt)
+        with self._read_lock:
+            try:
+                with self._reader:
+                    self._reader.execute(
+                        "INSERT INTO accounts (user_id, salt, password_hash, created_at) VALUES (?, ?, ?, ?)",
+                        (user_id, salt, password_hash, time.time()),
+                    )
+                    for table in ("messages", "stats", "summaries"):
+                        self._reader.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+    def verify_account(self, user_id, password):
+        """Whether ``user_id`` has an account and ``password`` is its password."""
+        with self._read_lock:
+            row = self._reader.execute("SELECT salt, password_hash FROM accounts WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None: # Hash anyway, so an unknown id takes as long as a wrong password
+            hmac.compare_digest(hash_password(password, UNKNOWN_ACCOUNT_SALT), bytes(32))
+            return False
+        return hmac.compare_digest(hash_password(password, row[0]), row[1])
+
+    def load_messages(self, user_id, persona, before_id=None, limit=CHAT_HISTORY_PAGE_SIZE):
+        """Returns (messages oldest first, has_earlier) for the page of history before ``before_id``."""
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT id, role, text FROM messages WHERE user_id = ? AND persona = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (user_id, persona, before_id if before_id is not None else 2 ** 63 - 1, limit + 1),
+            ).fetchall()
+        has_earlier = len(rows) > limit
+        return [{"id": row[0], "role": row[1], "text": row[2]} for row in reversed(rows[:limit])], has_earlier
+
+    def load_stats(self, user_id):
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT messages_sent, total_questions, correct_answers FROM stats WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return dict(zip(("messages_sent", "total_questions", "correct_answers"), row or (0, 0, 0)))
+
+    def load_summary(self, user_id, persona):
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT summary FROM summaries WHERE user_id = ? AND persona = ?", (user_id, persona)
+            ).fetchone()
+        return row[0] if row else ""
+
+@st.cache_resource
+def get_session_store():
+    """Returns the process-wide session store, with its write queue exported to the metrics registry."""
+    store = SessionStore(SESSION_DB_PATH)
+    export_stats(get_metrics_registry(), "sanskritai_session_store", store.stats, {
+        "pending_writes": ("gauge", "History writes queued for the session store."),
+        "failed_batches": ("counter", "Session store write batches that failed and were retried one write at a time."),
+        "dropped_writes": ("counter", "History writes lost after failing on their own."),
+    })
+    return store
+
+def account_store():
+    """Returns the session store, or None when it can't be opened; logins are then not verified and keep no history."""
+    try:
+        return get_session_store()
+    except (OSError, sqlite3.Error):
+        return None
+
+def current_session_store():
+    """Returns (store, user_id) for the logged-in user, or (None, None) when history can't be persisted.
+
+    ``user_id`` is only set by a signup or a login whose password was checked against the store.
+    """
+    user_id = st.session_state.get("user_id")
+    store = account_store() if user_id else None
+    return (store, user_id) if store is not None else (None, None)
+
+def record_stat(name, amount=1):
+    """Increments a learning stat in the session and queues the same delta for the session store."""
+    st.session_state[name] += amount
+    store, user_id = current_session_store()
+    if store is not None:
+        store.add_stats(user_id, **{name: amount})
+
+def open_persona_chat(model, persona, greeting):
+    """Creates the ChatContext for ``persona``, restoring its newest history page and summary from the store."""
+    store, user_id = current_session_store()
+    if store is None:
+        return ChatContext(model, greeting)
+
+    def persist(user_message, model_message, summary):
+        store.append_message(user_id, persona, "user", user_message.text)
+        store.append_message(user_id, persona, "model", model_message.text)
+        if summary is not None:
+            store.save_summary(user_id, persona, summary)
+
+    history, has_earlier = store.load_messages(user_id, persona)
+    return ChatContext(model, greeting, history, store.load_summary(user_id, persona), has_earlier, on_turn=persist)
+
+def load_earlier_history(chat, persona):
+    """Prepends the next older page of stored history to ``chat``."""
+    store, user_id = current_session_store()
+    if store is None or not chat.has_earlier:
+        return
+    messages, has_earlier = store.load_messages(user_id, persona, before_id=chat.transcript[0].id)
+    chat.prepend_history(messages, has_earlier)
+
+# --- Session Memory ---
+SpillRef = namedtuple("SpillRef", "session offset length")
+
+class SpillStore:
+    """Append-only disk store for payloads that sessions have moved out of memory.
+
+    Each session appends to its own file and addresses a blob by (offset, length),
+    so spilling is one append and reloading one seek and read. A session's file is
+    deleted when it logs out; files left idle for ``ttl_seconds`` are swept when the
+    store starts.
+    """
+
+    def __init__(self, directory, ttl_seconds):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._sizes = {}
+        self._sweep()
+
+    def _path(self, session):
+        return os.path.join(self.directory, f"{session}.spill")
+
+    def put_many(self, session, blobs):
+        """Appends ``blobs`` to the session's file and returns a SpillRef for each."""
+        if not blobs:
+            return []
+        refs = []
+        with self._lock, open(self._path(session), "ab") as f:
+            offset = f.tell()
+            for blob in blobs:
+                f.write(blob)
+                refs.append(SpillRef(session, offset, len(blob)))
+                offset += len(blob)
+            self._sizes[session] = offset
+        return refs
+
+    def put(self, session, blob):
+        return self.put_many(session, [blob])[0]
+
+    def get(self, ref):
+        with open(self._path(ref.session), "rb") as f:
+            f.seek(ref.offset)
+            return f.read(ref.length)
+
+    def disk_bytes(self, session):
+        return self._sizes.get(session, 0)
+
+    def discard(self, session):
+        with self._lock:
+            self._sizes.pop(session, None)
+            try:
+                os.remove(self._path(session))
+            except FileNotFoundError:
+                pass
+
+    def _sweep(self):
+        cutoff = time.time() - self.ttl_seconds
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith(".spill") and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+@st.cache_resource
+def get_spill_store():
+    """Returns the process-wide spill store."""
+    return SpillStore(SPILL_DIR, SPILL_TTL_SECONDS)
+
+def message_text(message):
+    """Returns a chat message's text, reading it back from the spill store if it was spilled."""
+    if not isinstance(message.text, SpillRef):
+        return message.text
+    try:
+        return get_spill_store().get(message.text).decode("utf-8")
+    except OSError:
+        return "_(This message is no longer available.)_"
+
+def payload_size(value, seen=None):
+    """Approximate bytes held by ``value`` and what it references, counting shared objects once.
+
+    Chat contexts count their running transcript size and summary but not the shared
+    model and gateway handles.
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, ChatContext):
+        size += value.resident_bytes + sys.getsizeof(value.summary)
+    elif isinstance(value, dict):
+        size += sum(payload_size(k, seen) + payload_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset, deque)):
+        size += sum(payload_size(v, seen) for v in value)
+    return size
+
+def measure_session_state():
+    """Returns {session state key: approximate bytes} for the current session."""
+    seen = set()
+    return {key: payload_size(st.session_state[key], seen) for key in list(st.session_state.keys())}
+
+def spill_recording(recorder_key):
+    """Moves a consumed mic_recorder clip to the spill store, leaving a SpillRef in the recorder's output."""
+    output = st.session_state.get(f"{recorder_key}_output")
+    if output and isinstance(output.get("bytes"), bytes):
+        try:
+            output["bytes"] = get_spill_store().put(session_id(), output["bytes"])
+        except OSError:
+            output["bytes"] = None # No room on disk: drop the clip rather than keep it resident
+
+class SessionMemoryRegistry:
+    """Latest memory measurement of every active session, for the admin view."""
+
+    def __init__(self, idle_seconds):
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def report(self, session, user_id, usage, spilled):
+        largest = max(usage, key=usage.get) if usage else ""
+        with self._lock:
+            self._sessions[session] = {
+                "user": user_id, "bytes": sum(usage.values()), "largest": largest,
+                "largest_bytes": usage.get(largest, 0), "spilled": spilled, "seen": time.time(),
+            }
+
+    def forget(self, session):
+        with self._lock:
+            self._sessions.pop(session, None)
+
+    def heaviest(self, limit=10):
+        """Returns (active session count, total resident bytes, the ``limit`` heaviest sessions)."""
+        cutoff = time.time() - self.idle_seconds
+        with self._lock:
+            for session in [k for k, v in self._sessions.items() if v["seen"] < cutoff]:
+                del self._sessions[session]
+            sessions = [dict(entry, session=session) for session, entry in self._sessions.items()]
+        sessions.sort(key=lambda entry: entry["bytes"], reverse=True)
+        return len(sessions), sum(entry["bytes"] for entry in sessions), sessions[:limit]
+
+@st.cache_resource
+def get_session_memory_registry():
+    """Returns the process-wide session memory registry."""
+    return SessionMemoryRegistry(SESSION_IDLE_SECONDS)
+
+def enforce_session_memory(limit=SESSION_MEMORY_LIMIT_BYTES):
+    """Measures this session and, if it is over ``limit``, spills every chat message that isn't on screen.
+
+    The active chat keeps its visible page; every chat keeps the turns it still sends
+    upstream. Returns the resident bytes after spilling.
+    """
+    usage = measure_session_state()
+    session = session_id()
+    try:
+        store = get_spill_store()
+    except OSError:
+        store = None
+    chats = st.session_state.get("persona_chats", {}).values()
+    # Skip the pass while the chats hold no more than they did after the last one: what is left can't be spilled
+    if store is not None and sum(usage.values()) > limit and sum(chat.resident_bytes for chat in chats) > st.session_state.get("spill_floor_bytes", 0):
+        active = st.session_state.get("chat")
+        visible = st.session_state.get("history_visible", CHAT_HISTORY_PAGE_SIZE)
+        spilled = 0
+        try:
+            for chat in chats:
+                spilled += chat.spill(store, session, keep=visible if chat is active else 0)
+        except OSError:
+            pass # Disk full or unwritable: stay over the cap rather than fail the page
+        st.session_state.spill_floor_bytes = sum(chat.resident_bytes for chat in chats)
+        if spilled:
+            st.session_state.rendered_messages = {}
+            usage = measure_session_state()
+    get_session_memory_registry().report(
+        session, st.session_state.get("user_id"), usage, store.disk_bytes(session) if store is not None else 0
+    )
+    return sum(usage.values())
+
+def release_session_memory():
+    """Drops this session's spill file and admin entry (on logout)."""
+    session = session_id()
+    get_session_memory_registry().forget(session)
+    try:
+        get_spill_store().discard(session)
+    except OSError:
+        pass
+
+def admin_password_matches(password):
+    """Whether ``password`` is the ADMIN_PASSWORD secret; admin ids log in with it instead of an account."""
+    try:
+        secret = st.secrets["ADMIN_PASSWORD"]
+    except (KeyError, FileNotFoundError):
+        return False # No secret configured: nobody is an admin
+    return hmac.compare_digest(password.encode("utf-8"), str(secret).encode("utf-8"))
+
+def is_admin():
+    return st.session_state.get("is_admin", False)
+
+# --- Audio Cache ---
+class AudioCache:
+    """Two-tier cache of synthesized MP3 audio keyed by a hash of (text, lang, slow).
+
+    The first tier is an in-process LRU capped by total bytes. The second tier is a
+    directory of ``<key>.mp3`` blobs shared by all sessions and processes; files are
+    written atomically and the least recently used ones are evicted once the
+    directory grows past its byte cap.
+    """
+
+    def __init__(self, directory, memory_limit, disk_limit):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None # Scanned lazily on the first write
+        self._lock = threading.Lock()
+        self._inflight = {}
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            self.directory = None # Read-only filesystem: run memory-only
+
+    @staticmethod
+    def make_key(text, lang, slow):
+        payload = json.dumps([text, lang, bool(slow)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def _remember(self, key, data):
+        """Inserts into the memory tier and evicts LRU entries over the byte cap. Caller holds the lock."""
+        if len(data) > self.memory_limit:
+            return
+        if key in self._entries:
+            self._memory_bytes -= len(self._entries.pop(key))
+        self._entries[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_limit:
+            _, evicted = self._entries.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def get(self, key):
+        """Returns cached bytes for ``key`` or None, promoting disk hits into memory."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return data
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._remember(key, data)
+        self._write_disk(key, data)
+
+    def get_or_create(self, key, factory):
+        """Returns cached bytes or calls ``factory()`` once, even under concurrent requests for the same key."""
+        data = self.get(key)
+        if data is not None:
+            return data
+        with self._lock:
+            key_lock = self._inflight.setdefault(key, threading.Lock())
+        with key_lock:
+            try:
+                with self._lock:
+                    data = self._entries.get(key)
+                if data is None:
+                    data = factory()
+                    self.put(key, data)
+                return data
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+
+    def _read_disk(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path) # Refresh recency for disk eviction
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, key, data):
+        if self.directory is None:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            else:
+                self._disk_bytes += len(data)
+            if self._disk_bytes > self.disk_limit:
+                self._evict_disk()
+
+    def _scan_disk_bytes(self):
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".mp3"):
+                    try:
+                        total += entry.stat().st_size
+                    except OSError:
+                        pass
+        return total
+
+    def _evict_disk(self):
+        """Deletes least recently used blobs until the directory is back under 90% of its cap. Caller holds the lock."""
+        files = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".mp3"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = int(self.disk_limit * 0.9)
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass # Another process got there first
+        self._disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._entries),
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+            }
+
+@st.cache_resource
+def get_audio_cache():
+    """Returns the process-wide TTS audio cache (survives Streamlit reruns), exported to the metrics registry."""
+    cache = AudioCache(TTS_CACHE_DIR, TTS_MEMORY_CACHE_BYTES, TTS_DISK_CACHE_BYTES)
+    export_stats(get_metrics_registry(), "sanskritai_tts_cache", cache.stats, {
+        "memory_hits": ("counter", "Audio served from the in-process LRU."),
+        "disk_hits": ("counter", "Audio served from the shared disk cache."),
+        "misses": ("counter", "Audio that had to be synthesized."),
+        "memory_entries": ("gauge", "Clips held in the in-process LRU."),
+        "memory_bytes": ("gauge", "Bytes held in the in-process LRU."),
+        "disk_bytes": ("gauge", "Bytes in the shared disk cache."),
+    })
+    return cache
+
+# --- Quiz Question Pool ---
+QUIZ_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string"},
+            "options": {"type": "array", "items": {"type": "string"}},
+            "answer": {"type": "string"},
+            "explanation": {"type": "string"},
+        },
+        "required": ["question", "options", "answer", "explanation"],
+    },
+}
+
+def validate_quiz_question(item):
+    """Returns a cleaned quiz question dict, or None if ``item`` does not match the quiz schema."""
+    if not isinstance(item, dict):
+        return None
+    question = item.get("question")
+    options = item.get("options")
+    answer = item.get("answer")
+    explanation = item.get("explanation", "")
+    if not isinstance(question, str) or not question.strip():
+        return None
+    if not isinstance(options, list) or not 2 <= len(options) <= 6:
+        return None
+    if not all(isinstance(o, str) and o.strip() for o in options):
+        return None
+    options = [o.strip() for o in options]
+    if len(set(options)) != len(options):
+        return None
+    if not isinstance(answer, str):
+        return None
+    answer = answer.strip()
+    if answer not in options and len(answer) == 1 and "A" <= answer.upper() < chr(65 + len(options)):
+        answer = options[ord(answer.upper()) - 65] # Model answered with the option letter
+    if answer not in options or not isinstance(explanation, str):
+        return None
+    return {"question": question.strip(), "options": options, "answer": answer, "explanation": explanation.strip()}
+
+class QuizPool:
+    """Process-wide pools of pre-generated quiz questions keyed by (persona, difficulty).
+
+    Each refill asks the model for a whole batch in one structured-output call and keeps
+    only the questions that validate. Taking a question below the low-water mark starts
+    a background refill, so only a cold pool ever waits on the model.
+    """
+
+    def __init__(self, batch_size, low_water, gateway=None):
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self.gateway = gateway
+        self._pools = {}
+        self._refilling = set()
+        self._cond = threading.Condition()
+
+    def take(self, model, persona, difficulty, focus):
+        """Returns the next question for (persona, difficulty), or None if generation failed."""
+        key = (persona, difficulty)
+        with self._cond:
+            pool = self._pools.setdefault(key, deque())
+            item = pool.popleft() if pool else None
+        if item is None:
+            self._refill(model, key, focus)
+            with self._cond:
+                item = pool.popleft() if pool else None
+        with self._cond:
+            low = len(pool) < self.low_water and key not in self._refilling
+        if low:
+            threading.Thread(target=self._refill, args=(model, key, focus), daemon=True).start()
+        return item
+
+    def size(self, persona, difficulty):
+        with self._cond:
+            return len(self._pools.get((persona, difficulty), ()))
+
+    def _refill(self, model, key, focus):
+        with self._cond:
+            if key in self._refilling:
+                # Another thread is already generating this batch; wait for it instead of duplicating the call
+                self._cond.wait_for(lambda: key not in self._refilling)
+                return
+            self._refilling.add(key)
+        questions = []
+        metrics = self.gateway.metrics if self.gateway is not None else None
+        try:
+            with metrics.labeled(persona=key[0], feature="quiz") if metrics is not None else contextlib.nullcontext(): # Refills run on their own threads
+                questions = self._generate_batch(model, key[1], focus)
+        except Exception:
+            pass # A failed batch leaves the pool as it was; the next take() retries
+        finally:
+            with self._cond:
+                pool = self._pools.setdefault(key, deque())
+                seen = {q["question"] for q in pool}
+                for q in questions:
+                    if q["question"] not in seen:
+                        seen.add(q["question"])
+                        pool.append(q)
+                self._refilling.discard(key)
+                self._cond.notify_all()
+
+    def _generate_batch(self, model, difficulty, focus):
+        prompt = (
+            f"Generate {self.batch_size} distinct multiple-choice quiz questions for a Sanskrit learner. "
+            f"Difficulty: {difficulty}. Focus area: {focus} "
+            "Each question must have 4 options, an answer copied verbatim from the options, and a one or two sentence explanation."
+        )
+        generation_config = {"response_mime_type": "application/json", "response_schema": QUIZ_RESPONSE_SCHEMA}
+        if self.gateway is None:
+            response = model.generate_content(prompt, generation_config=generation_config)
+        else:
+            response = self.gateway.call(SYSTEM_UPSTREAM_KEY, model.generate_content, prompt, generation_config=generation_config)
+        items = json.loads(response.text)
+        if isinstance(items, dict):
+            items = [items]
+        return [q for q in map(validate_quiz_question, items) if q is not None]
+
+@st.cache_resource
+def get_quiz_pool():
+    """Returns the process-wide quiz question pool."""
+    return QuizPool(QUIZ_POOL_BATCH_SIZE, QUIZ_POOL_LOW_WATER, get_upstream_gateway())
+
+# --- Audio Preprocessing ---
+def decode_wav(data):
+    """Decodes PCM WAV bytes into (mono float32 samples in [-1, 1], sample rate)."""
+    with wave.open(io.BytesIO(data), "rb") as wav:
+        channels, width, rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+        raw = wav.readframes(wav.getnframes())
+    if width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    elif width == 2:
+        samples = np.frombuffer(raw, dtype="<i2").astype(np.float32) / 32768.0
+    elif width == 3:
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        ints = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+        samples = (np.where(ints >= 1 << 23, ints - (1 << 24), ints) / float(1 << 23)).astype(np.float32)
+    elif width == 4:
+        samples = np.frombuffer(raw, dtype="<i4").astype(np.float32) / 2147483648.0
+    else:
+        raise ValueError(f"Unsupported WAV sample width: {width}")
+    samples = samples[: len(samples) - len(samples) % channels].reshape(-1, channels)
+    return samples.mean(axis=1), rate
+
+def trim_silence(samples, rate, threshold_db=AUDIO_SILENCE_THRESHOLD_DB, pad_ms=AUDIO_SILENCE_PAD_MS, frame_ms=20):
+    """Drops leading and trailing frames whose RMS energy is ``threshold_db`` below the loudest frame."""
+    frame = max(1, rate * frame_ms // 1000)
+    n_frames = len(samples) // frame
+    if n_frames == 0:
+        return samples
+    rms = np.sqrt(np.mean(samples[: n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    peak = rms.max()
+    if peak < 1e-4:
+        return samples # Effectively silent; leave it for the model to judge
+    active = np.flatnonzero(rms >= peak * 10 ** (threshold_db / 20))
+    pad = rate * pad_ms // 1000
+    start = max(0, active[0] * frame - pad)
+    end = min(len(samples), (active[-1] + 1) * frame + pad)
+    return samples[start:end]
+
+def resample(samples, rate, target_rate=AUDIO_TARGET_RATE):
+    """Resamples by linear interpolation, with a moving-average anti-alias filter when downsampling."""
+    if rate == target_rate or len(samples) == 0:
+        return samples
+    if rate > target_rate:
+        width = int(round(rate / target_rate))
+        if width > 1:
+            samples = np.convolve(samples, np.ones(width, dtype=np.float32) / width, mode="same")
+    n_out = int(round(len(samples) * target_rate / rate))
+    positions = np.arange(n_out, dtype=np.float64) * (rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+def encode_audio(samples, rate):
+    """Encodes mono float samples as FLAC when soundfile is installed, otherwise as 16-bit PCM WAV."""
+    try:
+        import soundfile # Optional: lossless compression roughly halves the payload
+        buffer = io.BytesIO()
+        soundfile.write(buffer, samples, rate, format="FLAC", subtype="PCM_16")
+        return buffer.getvalue(), "audio/flac"
+    except ImportError:
+        pass
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+    return buffer.getvalue(), "audio/wav"
+
+def prepare_audio(data):
+    """Trims silence, downmixes and resamples a WAV recording. Returns (bytes, mime type).
+
+    Audio that isn't PCM WAV is passed through unchanged.
+    """
+    try:
+        samples, rate = decode_wav(data)
+    except (wave.Error, EOFError, ValueError):
+        return data, "audio/wav"
+    samples = resample(trim_silence(samples, rate), rate)
+    return encode_audio(samples, AUDIO_TARGET_RATE)
+
+@contextlib.contextmanager
+def audio_part(data, call=None):
+    """Yields a request part for a recording: inline bytes when small, otherwise an uploaded file deleted afterwards.
+
+    ``call`` runs the upload and delete; it defaults to call_upstream, and worker threads
+    pass an upstream_caller() instead.
+    """
+    call = call or call_upstream
+    payload, mime_type = prepare_audio(data)
+    if len(payload) <= AUDIO_INLINE_MAX_BYTES:
+        yield {"mime_type": mime_type, "data": payload}
+        return
+    uploaded = call(genai.upload_file, io.BytesIO(payload), mime_type=mime_type)
+    try:
+        yield uploaded
+    finally:
+        call(genai.delete_file, uploaded.name)
+
+# --- Shloka Corpus ---
+def strip_diacritics(text):
+    """Lower-cases and strips combining marks: 'Gītā' gives 'gita'."""
+    return "".join(ch for ch in unicodedata.normalize("NFKD", text.casefold()) if not unicodedata.combining(ch))
+
+def fold_diacritics(text):
+    """Like strip_diacritics, but also folds common ASCII spellings so 'geeta' and 'upanishad' match 'Gītā' and 'Upaniṣad'."""
+    return strip_diacritics(text).replace("sh", "s").replace("ee", "i").replace("oo", "u")
+
+def count_aksharas(text):
+    """Counts Devanagari syllables: independent vowels plus consonants not followed by a virama."""
+    count = 0
+    for i, ch in enumerate(text):
+        if "\u0904" <= ch <= "\u0914" or ch == "\u0960":
+            count += 1
+        elif ("\u0915" <= ch <= "\u0939" or "\u0958" <= ch <= "\u095f") and text[i + 1:i + 2] != "\u094d":
+            count += 1
+    return count
+
+def write_index_file(index_path, chunks):
+    """Writes ``chunks`` to ``index_path`` through a temporary file, so a reader never maps a half-written index."""
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path) or ".", suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_path, index_path)
+
+def map_index_file(source_path, index_path, build, header, magic, kind):
+    """Memory-maps the index built from ``source_path``, (re)building it when missing or older; returns the map and header fields."""
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(source_path):
+        build(source_path, index_path)
+    with open(index_path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    fields = header.unpack_from(mm, 0)
+    if fields[0] != magic:
+        mm.close()
+        os.remove(index_path)
+        raise ValueError(f"{index_path} is not a {kind} index; it will be rebuilt on the next load.")
+    return mm, fields[1:]
+
+class ShlokaCorpus:
+    """Recitation shlokas backed by a compact, memory-mapped binary index.
+
+    Index layout: a header (magic, record count, name table offset and length), one
+    16-byte record per shloka (text offset and length, source and meter ids, syllable
+    count, difficulty, reference length), the UTF-8 texts each followed by their
+    reference, and a small JSON table of source and meter names. The index is rebuilt
+    from the JSON corpus whenever that file is newer. Selection is a vectorized filter
+    over the record array and never parses the texts it doesn't return.
+    """
+
+    MAGIC = b"SHLOKA01"
+    HEADER = struct.Struct("<8sIII")
+    RECORD_DTYPE = np.dtype([
+        ("text_offset", "<u4"), ("text_length", "<u4"), ("source", "<u2"), ("meter", "<u2"),
+        ("syllables", "<u2"), ("difficulty", "u1"), ("ref_length", "u1"),
+    ])
+
+    def __init__(self, corpus_path, index_path):
+        self.corpus_path = corpus_path
+        self.index_path = index_path
+        self._mm = None
+        self._records = None
+        self._sources = self._meters = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build_index(cls, corpus_path, index_path):
+        with open(corpus_path, encoding="utf-8") as f:
+            entries = json.load(f)
+        sources, meters = [], []
+        records = np.zeros(len(entries), dtype=cls.RECORD_DTYPE)
+        blob = bytearray()
+        for i, entry in enumerate(entries):
+            for names, field in ((sources, "source"), (meters, "meter")):
+                if entry[field] not in names:
+                    names.append(entry[field])
+            text = entry["text"].encode("utf-8")
+            ref = entry.get("ref", "").encode("utf-8")[:255]
+            records[i] = (cls.HEADER.size + records.nbytes + len(blob), len(text), sources.index(entry["source"]),
+                          meters.index(entry["meter"]), count_aksharas(entry["text"]), entry.get("difficulty", 2), len(ref))
+            blob += text + ref
+        names = json.dumps({"sources": sources, "meters": meters}, ensure_ascii=False).encode("utf-8")
+        names_offset = cls.HEADER.size + records.nbytes + len(blob)
+        write_index_file(index_path, (cls.HEADER.pack(cls.MAGIC, len(entries), names_offset, len(names)), records.tobytes(), blob, names))
+
+    def _load(self):
+        with self._lock:
+            if self._records is not None:
+                return
+            mm, (count, names_offset, names_length) = map_index_file(
+                self.corpus_path, self.index_path, self.build_index, self.HEADER, self.MAGIC, "shloka")
+            names = json.loads(mm[names_offset:names_offset + names_length].decode("utf-8"))
+            self._sources, self._meters = names["sources"], names["meters"]
+            self._records = np.frombuffer(mm, dtype=self.RECORD_DTYPE, count=count, offset=self.HEADER.size)
+            self._mm = mm
+
+    def __len__(self):
+        self._load()
+        return len(self._records)
+
+    def get(self, shloka_id):
+        self._load()
+        r = self._records[shloka_id]
+        start, end = int(r["text_offset"]), int(r["text_offset"]) + int(r["text_length"])
+        return {
+            "id": int(shloka_id),
+            "text": self._mm[start:end].decode("utf-8"),
+            "ref": self._mm[end:end + int(r["ref_length"])].decode("utf-8"),
+            "source": self._sources[r["source"]],
+            "meter": self._meters[r["meter"]],
+            "syllables": int(r["syllables"]),
+            "difficulty": int(r["difficulty"]),
+        }
+
+    def select(self, difficulty=None, query=None, progress=None, rng=random):
+        """Picks a shloka id, or returns None when ``query`` matches nothing in the corpus.
+
+        ``query`` is matched against source and meter names, and ``difficulty`` also
+        caps the length (see SHLOKA_MAX_SYLLABLES). ``progress`` is the learner's
+        spaced-repetition state (see record_practice): shlokas that are due come first
+        and are drawn with weight 1 / (1 + Leitner box).
+        """
+        self._load()
+        records = self._records
+        mask = np.ones(len(records), dtype=bool)
+        if query:
+            q = fold_diacritics(transliterate(query.strip(), "devanagari", "iast")) # "गीता" finds the Gītā too
+            source_ids = [i for i, name in enumerate(self._sources) if q in fold_diacritics(name)]
+            meter_ids = [i for i, name in enumerate(self._meters) if q in fold_diacritics(name)]
+            mask &= np.isin(records["source"], source_ids) | np.isin(records["meter"], meter_ids)
+            if not mask.any():
+                return None
+        if difficulty is not None and (mask & (records["difficulty"] == difficulty)).any():
+            mask &= records["difficulty"] == difficulty
+        max_syllables = SHLOKA_MAX_SYLLABLES.get(difficulty)
+        if max_syllables is not None and (mask & (records["syllables"] <= max_syllables)).any():
+            mask &= records["syllables"] <= max_syllables
+        progress = progress or {}
+        box = np.zeros(len(records))
+        due_at = np.zeros(len(records))
+        for shloka_id, (b, due) in progress.get("boxes", {}).items():
+            box[shloka_id], due_at[shloka_id] = b, due
+        due = mask & (due_at <= progress.get("round", 0))
+        pool = np.flatnonzero(due if due.any() else mask)
+        return int(rng.choices(pool.tolist(), weights=(1.0 / (1.0 + box[pool])).tolist())[0])
+
+    MAX_BOX = 6
+
+    @classmethod
+    def record_practice(cls, progress, shloka_id, success=True):
+        """Moves a shloka between Leitner boxes; box ``b`` comes due again after 2**b practice rounds."""
+        progress["round"] = progress.get("round", 0) + 1
+        boxes = progress.setdefault("boxes", {})
+        box = min(boxes.get(shloka_id, (0, 0))[0] + 1, cls.MAX_BOX) if success else 0
+        boxes[shloka_id] = (box, progress["round"] + 2 ** box)
+
+@st.cache_resource
+def get_shloka_corpus():
+    """Returns the process-wide shloka corpus; the index is only opened on first selection."""
+    return ShlokaCorpus(SHLOKA_CORPUS_PATH, SHLOKA_INDEX_PATH)
+
+# --- Pronunciation Scoring ---
+def decode_audio(data):
+    """Decodes WAV, or any format soundfile can read (MP3 needs libsndfile 1.1+), into (mono float32 samples, rate)."""
+    try:
+        return decode_wav(data)
+    except (wave.Error, EOFError, ValueError):
+        pass
+    try:
+        import soundfile # Optional: needed to decode the MP3 reference from gTTS
+    except ImportError:
+        raise ValueError("Decoding compressed audio needs the soundfile package.")
+    try:
+        samples, rate = soundfile.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    except RuntimeError as e: # soundfile.LibsndfileError
+        raise ValueError(f"Could not decode audio: {e}")
+    return samples.mean(axis=1), rate
+
+def mel_filterbank(n_mels, n_fft, rate):
+    """Triangular mel filters as an (n_mels, n_fft // 2 + 1) matrix."""
+    mels = np.linspace(0.0, 2595 * np.log10(1 + rate / 2 / 700), n_mels + 2)
+    hz = 700 * (10 ** (mels / 2595) - 1)
+    bins = np.fft.rfftfreq(n_fft, 1 / rate)
+    lower, center, upper = hz[:-2, None], hz[1:-1, None], hz[2:, None]
+    rising = (bins - lower) / (center - lower)
+    falling = (upper - bins) / (upper - center)
+    return np.maximum(0.0, np.minimum(rising, falling)).astype(np.float32)
+
+def mfcc_features(samples, rate, n_mfcc=PRONUNCIATION_MFCC_COUNT, n_mels=PRONUNCIATION_MEL_BANDS):
+    """Returns (MFCC frames, per-frame log energy) at a 10 ms hop.
+
+    c0 is dropped and each coefficient's utterance mean is subtracted, so loudness and
+    microphone colouring don't count against the speaker.
+    """
+    samples = resample(samples, rate)
+    frame = AUDIO_TARGET_RATE * PRONUNCIATION_FRAME_MS // 1000
+    hop = AUDIO_TARGET_RATE * PRONUNCIATION_HOP_MS // 1000
+    if len(samples) < frame:
+        samples = np.pad(samples, (0, frame - len(samples)))
+    emphasized = np.append(samples[:1], samples[1:] - 0.97 * samples[:-1])
+    frames = np.lib.stride_tricks.sliding_window_view(emphasized, frame)[::hop] * np.hamming(frame).astype(np.float32)
+    n_fft = 1 << (frame - 1).bit_length()
+    power = np.abs(np.fft.rfft(frames, n_fft)) ** 2 / n_fft
+    log_mel = np.log(power @ mel_filterbank(n_mels, n_fft, AUDIO_TARGET_RATE).T + 1e-10)
+    dct = np.cos(np.pi / n_mels * (np.arange(n_mels) + 0.5)[None, :] * np.arange(n_mfcc)[:, None])
+    mfcc = (log_mel @ dct.T)[:, 1:]
+    return (mfcc - mfcc.mean(axis=0)).astype(np.float32), np.log(power.sum(axis=1) + 1e-10)
+
+def dtw_align(reference, attempt):
+    """Aligns two feature sequences by dynamic time warping on cosine distance.
+
+    Returns (reference frame indices, attempt frame indices, distance at each step) along
+    the optimal path. Each row of the accumulated cost is computed in one vectorized pass:
+    diagonal and vertical steps elementwise, horizontal steps as a running minimum over
+    prefix sums.
+    """
+    ref = reference / (np.linalg.norm(reference, axis=1, keepdims=True) + 1e-8)
+    att = attempt / (np.linalg.norm(attempt, axis=1, keepdims=True) + 1e-8)
+    cost = 1.0 - ref @ att.T
+    n, m = cost.shape
+    acc = np.empty_like(cost)
+    acc[0] = np.cumsum(cost[0])
+    shifted = np.empty(m, dtype=cost.dtype)
+    for i in range(1, n):
+        shifted[0] = np.inf
+        shifted[1:] = acc[i - 1, :-1]
+        entry = cost[i] + np.minimum(acc[i - 1], shifted)
+        prefix = np.cumsum(cost[i])
+        acc[i] = prefix + np.minimum.accumulate(entry - prefix)
+    i, j = n - 1, m - 1
+    path = [(i, j)]
+    while i > 0 or j > 0:
+        if i == 0:
+            j -= 1
+        elif j == 0:
+            i -= 1
+        else:
+            step = np.argmin((acc[i - 1, j - 1], acc[i - 1, j], acc[i, j - 1]))
+            i, j = (i - 1, j - 1) if step == 0 else (i - 1, j) if step == 1 else (i, j - 1)
+        path.append((i, j))
+    path = np.array(path[::-1])
+    return path[:, 0], path[:, 1], cost[path[:, 0], path[:, 1]]
+
+def split_padas(text):
+    """Splits a shloka into padas: each danda-terminated half-verse, halved at the word break nearest its middle syllable."""
+    padas = []
+    for half in re.split(r"[।॥\n]+", text):
+        half = re.sub(r"[०-९0-9]+", "", half).strip()
+        syllables = count_aksharas(half)
+        if syllables == 0:
+            continue
+        words = half.split()
+        if syllables >= 16 and len(words) > 1:
+            counts = np.cumsum([count_aksharas(word) for word in words])
+            cut = int(np.argmin(np.abs(counts[:-1] - syllables / 2))) + 1
+            padas += [" ".join(words[:cut]), " ".join(words[cut:])]
+        else:
+            padas.append(half)
+    return padas
+
+def pada_boundaries(padas, energy):
+    """Frame boundaries of each pada in the reference: split in proportion to syllable counts, then each cut moved to the quietest frame nearby."""
+    counts = np.array([max(1, count_aksharas(p)) for p in padas], dtype=np.float64)
+    n = len(energy)
+    cuts = np.round(np.cumsum(counts)[:-1] / counts.sum() * n).astype(int)
+    window = max(1, int(n * 0.6 / len(padas) / 2))
+    for k, cut in enumerate(cuts):
+        lo, hi = max(1, cut - window), min(n - 1, cut + window)
+        if hi > lo:
+            cuts[k] = lo + int(np.argmin(energy[lo:hi]))
+    cuts = np.maximum.accumulate(cuts) # Keep segments ordered if two searches overlap
+    return np.concatenate(([0], cuts, [n]))
+
+def distance_to_score(distance):
+    span = PRONUNCIATION_BAD_DISTANCE - PRONUNCIATION_GOOD_DISTANCE
+    return float(np.clip(100 * (PRONUNCIATION_BAD_DISTANCE - distance) / span, 0, 100))
+
+def score_recitation(recording, reference, shloka_text):
+    """Scores a recitation against a reference rendering of ``shloka_text``.
+
+    Both clips are trimmed of silence and aligned frame by frame. Returns a dict with
+    an overall 0-100 similarity, the tempo relative to the reference and, per pada, its
+    text, syllable count, start/end (ms from the first voiced frame of the recording),
+    reference length (ms) and similarity score. Raises ValueError if either clip can't
+    be decoded.
+    """
+    started = time.perf_counter()
+    ref_samples, ref_rate = decode_audio(reference)
+    att_samples, att_rate = decode_audio(recording)
+    ref_mfcc, ref_energy = mfcc_features(trim_silence(ref_samples, ref_rate), ref_rate)
+    att_mfcc, _ = mfcc_features(trim_silence(att_samples, att_rate), att_rate)
+    decimate = max(1, int(np.ceil(np.sqrt(len(ref_mfcc) * len(att_mfcc) / PRONUNCIATION_MAX_DTW_CELLS))))
+    ref_frames, att_frames, distances = dtw_align(ref_mfcc[::decimate], att_mfcc[::decimate])
+    frame_ms = PRONUNCIATION_HOP_MS * decimate
+    padas = split_padas(shloka_text) or [shloka_text.strip()]
+    bounds = pada_boundaries(padas, ref_energy[::decimate])
+    results = []
+    for k, pada in enumerate(padas):
+        on_path = (ref_frames >= bounds[k]) & (ref_frames < bounds[k + 1])
+        if not on_path.any():
+            continue
+        results.append({
+            "pada": pada,
+            "syllables": count_aksharas(pada),
+            "start_ms": int(att_frames[on_path].min() * frame_ms),
+            "end_ms": int((att_frames[on_path].max() + 1) * frame_ms),
+            "reference_ms": int((bounds[k + 1] - bounds[k]) * frame_ms),
+            "score": round(distance_to_score(distances[on_path].mean()), 1),
+        })
+    return {
+        "overall": round(distance_to_score(distances.mean()), 1),
+        "tempo": round(len(att_mfcc) / max(1, len(ref_mfcc)), 2),
+        "duration_ms": len(att_mfcc) * PRONUNCIATION_HOP_MS,
+        "reference_ms": len(ref_mfcc) * PRONUNCIATION_HOP_MS,
+        "padas": results,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+def recitation_feedback_prompt(shloka_text, scores):
+    """Asks the model to turn local pronunciation scores into a few friendly sentences; no audio is sent."""
+    padas = "\n".join(
+        f"- Pada {i + 1} ({p['pada']}): similarity {p['score']:.0f}/100, "
+        f"{p['end_ms'] - p['start_ms']} ms against {p['reference_ms']} ms in the reference"
+        for i, p in enumerate(scores["padas"])
+    )
+    return (
+        f"A learner recited this Sanskrit shloka:\n{shloka_text}\n\n"
+        f"A pronunciation checker compared their recording with a reference recitation. Overall similarity: "
+        f"{scores['overall']:.0f}/100. They took {scores['tempo']:.2f} times as long as the reference. Per pada:\n{padas}\n\n"
+        "Write 3-5 sentences of friendly feedback: say what went well, name the weakest pada and give one "
+        "concrete pronunciation tip for it. Don't repeat the numbers."
+    )
+
+# --- Response Cache ---
+def normalize_query(text):
+    """Canonical form of a question for cache lookups: NFC, Devanagari as IAST, case-folded, punctuation and whitespace collapsed."""
+    text = transliterate(text, "devanagari", "iast")
+    text = unicodedata.normalize("NFC", text.casefold())
+    text = re.sub(r"[^\w\s]|_", " ", text)
+    return " ".join(text.split())
+
+SELF_CONTAINED_QUERY = re.compile(
+    r"^(?:please )?(?:"
+    r"what (?:does|do) .+ mean(?: in sanskrit| in english)?"
+    r"|what is (?:the )?(?:meaning|definition|translation) of .+"
+    r"|(?:meaning|definition|translation) of .+"
+    r"|(?:define|translate) .+"
+    r"|how (?:do you|to) say .+ in sanskrit"
+    r"|what is .+ in (?:sanskrit|english)"
+    r"|\S+ meaning" # One term only: "explain dharma meaning" asks for an explanation
+    r")$"
+)
+CONTEXT_DEPENDENT_WORDS = {
+    "it", "this", "that", "these", "those", "he", "she", "they", "him", "her", "them", "his", "its",
+    "above", "previous", "earlier", "again", "more", "last", "same", "another", "else", "me", "my", "i",
+}
+
+def cacheable_query(text):
+    """Returns the normalized query if ``text`` is a short, self-contained lookup question, else None.
+
+    Anything that leans on the conversation so far (pronouns, "again", "more", ...)
+    is never cached, since its answer depends on context a shared cache can't see.
+    """
+    query = normalize_query(text)
+    words = query.split()
+    if not words or len(words) > 12 or CONTEXT_DEPENDENT_WORDS.intersection(words):
+        return None
+    return query if SELF_CONTAINED_QUERY.match(query) else None
+
+class ResponseCache:
+    """Process-wide LRU of model replies keyed by (persona, normalized query), with a TTL."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, persona, query):
+        key = (persona, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, persona, query, reply):
+        if not reply.strip():
+            return # A blocked or empty reply must not be served to everyone who asks next
+        with self._lock:
+            self._entries[(persona, query)] = (time.monotonic() + self.ttl_seconds, reply)
+            self._entries.move_to_end((persona, query))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "entries": len(self._entries)}
+
+@st.cache_resource
+def get_response_cache():
+    """Returns the process-wide persona response cache, exported to the metrics registry."""
+    cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS)
+    export_stats(get_metrics_registry(), "sanskritai_response_cache", cache.stats, {
+        "hits": ("counter", "Chat replies served from the response cache."),
+        "misses": ("counter", "Cacheable questions the response cache could not answer."),
+        "entries": ("gauge", "Replies held in the response cache."),
+    })
+    return cache
+
+# --- Lexicon ---
+LEXICON_SPELLING_FOLDS = (("ri", "r"), ("w", "v"), ("ch", "c")) # Applied after ending stripping, so 'krishna' meets 'kṛṣṇa'
+
+# (ending, stem final) pairs in the order they are tried: nominal case endings of a-, an-, in-, i-,
+# u- and ṛ-stems, final visarga sandhi (-o, -as, -ar for -aḥ) and voiced finals of consonant stems.
+LEXICON_ENDINGS = (
+    ("ebhyah", "a"), ("abhyam", "a"), ("abhih", "a"), ("asya", "a"), ("anam", "a"), ("aih", "a"), ("esu", "a"),
+    ("ena", "a"), ("aya", "a"), ("ani", "a"), ("ayah", "a"), ("ayam", "a"), ("ayai", "a"),
+    ("anah", "an"), ("ana", "an"), ("ane", "an"), ("ani", "an"), ("inah", "in"), ("ina", "in"),
+    ("ayah", "i"), ("aye", "i"), ("ave", "u"), ("avah", "u"), ("arah", "r"), ("aram", "r"),
+    ("ah", "a"), ("as", "a"), ("ar", "a"), ("am", "a"), ("at", "a"), ("au", "a"), ("e", "a"), ("o", "a"),
+    ("ih", "i"), ("im", "i"), ("eh", "i"), ("uh", "u"), ("um", "u"), ("oh", "u"), ("or", "u"), ("uh", "r"),
+    ("a", "an"), ("i", "in"), ("a", "r"),
+    ("d", "t"), ("t", "d"), ("g", "k"), ("k", "c"), ("b", "p"),
+)
+
+def lexicon_base(word, learner_spellings=True):
+    """Diacritic-free ASCII spelling of ``word`` that candidate generation works on: 'Dharmaḥ' and 'dharmaah' both give 'dharmah'."""
+    base = (fold_diacritics if learner_spellings else strip_diacritics)(word).replace("aa", "a").replace("ii", "i").replace("uu", "u")
+    return re.sub(r"[^a-z]", "", base)
+
+def lexicon_key(base):
+    """Index key for a base spelling, merging the remaining spellings learners use for one sound."""
+    for old, new in LEXICON_SPELLING_FOLDS:
+        base = base.replace(old, new)
+    return base
+
+def lexicon_candidates(base):
+    """Stems ``base`` may be a form of, most literal first: the word itself, then one per matching ending."""
+    yield base
+    for ending, stem_final in LEXICON_ENDINGS:
+        if base.endswith(ending) and len(base) - len(ending) >= 2:
+            yield base[:-len(ending)] + stem_final
+
+def sandhi_splits(base, at):
+    """(left, right) readings of a compound split at ``at``, undoing the vowel sandhi that may have merged its members there."""
+    left, right = base[:at], base[at:]
+    yield left, right
+    if left.endswith("a"): # a/ā + a/ā -> ā
+        yield left, "a" + right
+    elif left.endswith("e"): # a + i -> e
+        yield left[:-1] + "a", "i" + right
+    elif left.endswith("o"): # a + u -> o
+        yield left[:-1] + "a", "u" + right
+    elif left[-1] in "yv" and right[:1] in "aeiou": # i/u + vowel -> y/v + vowel
+        yield left[:-1] + ("i" if left.endswith("y") else "u"), right
+
+class LexiconIndex:
+    """Headword lexicon backed by a compact, memory-mapped index of sorted keys and postings.
+
+    Index layout: a header (magic, key, postings and entry counts), the lookup keys as
+    sorted fixed-width ASCII strings, one (start, count) range into the postings per
+    key, the postings (entry ids), one (offset, length) record per entry and the UTF-8
+    entries themselves. Keys are folded spellings of each headword and its listed
+    irregular forms, so entries that fold alike share a key. Lookups are binary searches
+    over the mapped keys and decode only the entries they return. The index is rebuilt
+    from the JSON lexicon whenever that file is newer.
+    """
+
+    MAGIC = b"LEXICON1"
+    HEADER = struct.Struct("<8sIII")
+    KEY_BYTES = 24
+    RANGE_DTYPE = np.dtype([("start", "<u4"), ("count", "<u4")])
+    ENTRY_DTYPE = np.dtype([("offset", "<u4"), ("length", "<u4")])
+    FIELD_SEPARATOR = "\x1f"
+
+    def __init__(self, lexicon_path, index_path):
+        self.lexicon_path = lexicon_path
+        self.index_path = index_path
+        self._mm = None
+        self._keys = self._ranges = self._postings = self._entries = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build_index(cls, lexicon_path, index_path):
+        with open(lexicon_path, encoding="utf-8") as f:
+            entries = json.load(f)
+        postings = {}
+        for i, entry in enumerate(entries):
+            for form in [entry["word"], *entry.get("forms", ())]:
+                for key in {lexicon_key(lexicon_base(form)), lexicon_key(lexicon_base(form, learner_spellings=False))}:
+                    if 0 < len(key) <= cls.KEY_BYTES and i not in postings.setdefault(key, []):
+                        postings[key].append(i)
+        keys = sorted(postings)
+        ranges = np.zeros(len(keys), dtype=cls.RANGE_DTYPE)
+        ids = []
+        for i, key in enumerate(keys):
+            ranges[i] = (len(ids), len(postings[key]))
+            ids.extend(postings[key])
+        ids = np.array(ids, dtype="<u4")
+        records = np.zeros(len(entries), dtype=cls.ENTRY_DTYPE)
+        blob = bytearray()
+        blob_offset = cls.HEADER.size + len(keys) * cls.KEY_BYTES + ranges.nbytes + ids.nbytes + records.nbytes
+        for i, entry in enumerate(entries):
+            text = cls.FIELD_SEPARATOR.join((entry["word"], entry["pos"], entry["meaning"])).encode("utf-8")
+            records[i] = (blob_offset + len(blob), len(text))
+            blob += text
+        write_index_file(index_path, (cls.HEADER.pack(cls.MAGIC, len(keys), len(ids), len(entries)),
+                                      np.array(keys, dtype=f"S{cls.KEY_BYTES}").tobytes(), ranges.tobytes(),
+                                      ids.tobytes(), records.tobytes(), blob))
+
+    def _load(self):
+        with self._lock:
+            if self._keys is not None:
+                return
+            mm, (key_count, postings_count, entry_count) = map_index_file(
+                self.lexicon_path, self.index_path, self.build_index, self.HEADER, self.MAGIC, "lexicon")
+            offset = self.HEADER.size
+            self._keys = np.frombuffer(mm, dtype=f"S{self.KEY_BYTES}", count=key_count, offset=offset)
+            offset += self._keys.nbytes
+            self._ranges = np.frombuffer(mm, dtype=self.RANGE_DTYPE, count=key_count, offset=offset)
+            offset += self._ranges.nbytes
+            self._postings = np.frombuffer(mm, dtype="<u4", count=postings_count, offset=offset)
+            offset += self._postings.nbytes
+            self._entries = np.frombuffer(mm, dtype=self.ENTRY_DTYPE, count=entry_count, offset=offset)
+            self._mm = mm
+
+    def __len__(self):
+        self._load()
+        return len(self._entries)
+
+    def _find(self, key):
+        """Entries filed under ``key``, decoded."""
+        if not key or len(key) > self.KEY_BYTES:
+            return []
+        needle = key.encode("ascii")
+        i = int(np.searchsorted(self._keys, needle))
+        if i == len(self._keys) or self._keys[i] != needle:
+            return []
+        start, count = int(self._ranges[i]["start"]), int(self._ranges[i]["count"])
+        found = []
+        for entry_id in self._postings[start:start + count]:
+            offset, length = int(self._entries[entry_id]["offset"]), int(self._entries[entry_id]["length"])
+            word, pos, meaning = self._mm[offset:offset + length].decode("utf-8").split(self.FIELD_SEPARATOR)
+            found.append({"word": word, "pos": pos, "meaning": meaning})
+        return found
+
+    def lookup(self, base):
+        """Entries for a base spelling (see lexicon_base): the word itself, else the first stem its ending points to."""
+        self._load()
+        for candidate in lexicon_candidates(base):
+            found = self._find(lexicon_key(candidate))
+            if found:
+                return found
+        return []
+
+    def analyze(self, word, max_parts=3):
+        """Reads ``word`` as listed headwords: a list of entry lists, one per member, or [] if it can't.
+
+        The word is looked up whole first, ending stripped if need be. Failing that, it is
+        split as a compound, longest first member first: every member but the last must
+        be a bare stem (an-stems drop their n), and the vowel sandhi at each join is undone.
+        """
+        base = lexicon_base(word)
+        plain = lexicon_base(word, learner_spellings=False)
+        if word.isascii() and plain != base: # 'tree' folds to 'tri': learner spellings of ASCII words must match exactly
+            self._load()
+            found = self._find(lexicon_key(plain))
+            return [found] if found else []
+        return self._analyze(base, max_parts) if len(base) >= 2 else []
+
+    def _analyze(self, base, max_parts):
+        found = self.lookup(base)
+        if found:
+            return [found]
+        if max_parts < 2:
+            return []
+        for at in range(len(base) - 2, 1, -1):
+            for left, right in sandhi_splits(base, at):
+                first = len(left) >= 2 and (self._find(lexicon_key(left)) or self._find(lexicon_key(left + "n")))
+                rest = first and self._analyze(right, max_parts - 1)
+                if rest:
+                    return [first] + rest
+        return []
+
+@st.cache_resource
+def get_lexicon():
+    """Returns the process-wide lexicon; the index is only opened on first lookup."""
+    return LexiconIndex(LEXICON_PATH, LEXICON_INDEX_PATH)
+
+LOOKUP_TERM = r"(?:the )?(?:sanskrit )?(?:word |term )?(\S+)"
+LEXICON_QUERY = re.compile(
+    r"^(?:please )?(?:"
+    rf"what (?:does|do) {LOOKUP_TERM} mean(?: in english)?"
+    rf"|what is (?:the )?(?:meaning|definition|translation) of {LOOKUP_TERM}"
+    rf"|(?:meaning|definition|translation) of {LOOKUP_TERM}"
+    rf"|define {LOOKUP_TERM}" # Not "translate": here it usually means English to Sanskrit
+    rf"|what is {LOOKUP_TERM} in english"
+    r"|(\S+) meaning"
+    r")$"
+)
+
+def lexicon_query_term(text):
+    """Returns the single word a pure "what does X mean?" question asks about, or None for anything else."""
+    match = LEXICON_QUERY.match(normalize_query(text))
+    if match is None:
+        return None
+    term = match.group(match.lastindex)
+    return None if len(term) < 2 or term in CONTEXT_DEPENDENT_WORDS else term
+
+def format_lexicon_reply(term, parts):
+    """Markdown reply for a lexicon hit: one line per entry, with the split shown for inflected forms and compounds."""
+    lines = []
+    headwords = [entries[0]["word"] for entries in parts]
+    if len(parts) > 1:
+        lines.append(f"*{term}* = " + " + ".join(headwords))
+    elif lexicon_key(lexicon_base(term)) != lexicon_key(lexicon_base(headwords[0])):
+        lines.append(f"*{term}* looks like a form of {headwords[0]}:")
+    for entries in parts:
+        for entry in entries:
+            lines.append(f"- **{transliterate(entry['word'], 'iast', 'devanagari')}** ({entry['word']}), *{entry['pos']}* — {entry['meaning']}")
+    lines.append("\n📖 *From the lexicon. Ask me to explain it if you'd like more detail.*")
+    return "\n".join(lines)
+
+def lexicon_reply(persona, text):
+    """Answers a pure lookup question from the lexicon; returns None when the model should answer instead."""
+    if persona not in LEXICON_PERSONAS:
+        return None
+    term = lexicon_query_term(text)
+    parts = get_lexicon().analyze(term) if term else []
+    return format_lexicon_reply(term, parts) if parts else None
+
+# --- Background Jobs ---
+BackgroundJob = namedtuple("BackgroundJob", "future label context")
+PAGE_JOBS = ("quiz", "shloka", "voice", "transcription") # Applied whatever screen is showing; "audio" and "listen" only play on their own screen
+
+@st.cache_resource
+def get_background_executor():
+    """Returns the process-wide worker pool. Jobs never call st.*; the script thread applies their results."""
+    return ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="sanskritai-job")
+
+def upstream_caller():
+    """call_upstream bound to the current session, for worker threads that can't read st.session_state."""
+    gateway, user_key = get_upstream_gateway(), session_user_key()
+    return lambda fn, *args, **kwargs: gateway.call(user_key, fn, *args, **kwargs)
+
+def submit_job(name, label, fn, *args, context=None):
+    """Starts ``fn(*args)`` as this session's ``name`` job, replacing any earlier job of that name."""
+    jobs = st.session_state.setdefault("background_jobs", {})
+    future = get_background_executor().submit(contextvars.copy_context().run, fn, *args) # Keeps the metric labels
+    jobs[name] = BackgroundJob(future, label, context)
+
+def finished_job(name):
+    """Removes and returns this session's ``name`` job once it is done, else None."""
+    jobs = st.session_state.get("background_jobs", {})
+    job = jobs.get(name)
+    if job is None or not job.future.done():
+        return None
+    return jobs.pop(name)
+
+@st.fragment(run_every=BACKGROUND_POLL_SECONDS)
+def watch_background_jobs(names):
+    """Lists the ``names`` jobs still running and reruns the whole page as soon as one of them is done."""
+    jobs = st.session_state.get("background_jobs", {})
+    watched = [jobs[name] for name in names if name in jobs]
+    if any(job.future.done() for job in watched):
+        st.rerun(scope="app")
+    for job in watched:
+        st.caption(f"⏳ {job.label}")
+
 # --- Helper Functions ---
-def text_to_audio(text):
-    """Converts text to speech using gTTS and returns audio bytes."""
+def synthesize_audio(text, lang='hi', slow=False, metrics=None):
+    """Runs a fresh gTTS synthesis and returns MP3 bytes, recording its latency, size and outcome in ``metrics``."""
+    started = time.perf_counter()
     try:
-        tts = gTTS(text=text, lang='hi', slow=False)
+        tts = gTTS(text=text, lang=lang, slow=slow)
         audio_fp = io.BytesIO()
         tts.write_to_fp(audio_fp)
         audio_fp.seek(0)
-        return audio_fp.read()
+        data = audio_fp.read()
+    except Exception as e:
+        if metrics is not None:
+            metrics.inc("sanskritai_tts_requests_total", outcome=type(e).__name__)
+        raise
+    if metrics is not None:
+        metrics.observe("sanskritai_tts_seconds", time.perf_counter() - started)
+        metrics.observe("sanskritai_tts_bytes", len(data))
+        metrics.inc("sanskritai_tts_requests_total", outcome="ok")
+    return data
+
+def audio_factory(text):
+    """AudioCache factory that synthesizes ``text``; the metrics registry is bound here so it can run on a worker."""
+    metrics = get_metrics_registry()
+    return lambda: synthesize_audio(text, metrics=metrics)
+
+def prefetch_audio(text):
+    """Synthesizes ``text`` into the audio cache in the background unless it is already there."""
+    if not SPECULATIVE_TTS:
+        return
+    cache, key = get_audio_cache(), AudioCache.make_key(text, 'hi', False)
+    if cache.get(key) is None:
+        get_background_executor().submit(contextvars.copy_context().run, cache.get_or_create, key, audio_factory(text))
+
+def request_audio(text, job_name, context=None):
+    """Returns the cached audio for ``text``, or starts synthesizing it as the ``job_name`` job and returns None."""
+    cache, key = get_audio_cache(), AudioCache.make_key(text, 'hi', False)
+    data = cache.get(key)
+    if data is None:
+        submit_job(job_name, "🔊 Preparing audio...", cache.get_or_create, key, audio_factory(text), context=context)
+    return data
+
+def job_audio(job):
+    """Audio bytes of a finished synthesis job, or None after a warning if it failed."""
+    try:
+        return job.future.result()
     except Exception as e:
         st.warning(f"Could not generate audio for the response. Error: {e}")
         return None
 
+def answer_voice_question(chat, data, call):
+    """Background job: answers a recorded question in one request and returns (transcript, reply)."""
+    with audio_part(data, call) as recording:
+        return chat.answer_voice(recording)
+
+def transcribe_recording(model, data, call):
+    """Background job: returns the text of a recorded question."""
+    with audio_part(data, call) as recording:
+        return call(model.generate_content, ["Transcribe this audio recording.", recording]).text.strip()
+
+def reference_recitation(text):
+    """Returns the TTS rendering of ``text`` that recitations are scored against, shared with the audio cache."""
+    return get_audio_cache().get_or_create(AudioCache.make_key(text, 'hi', False), audio_factory(text))
+
+def render_recitation_scores(scores):
+    """Shows the local pronunciation scores: overall similarity and tempo, then one row per pada."""
+    col1, col2 = st.columns(2)
+    col1.metric("🎯 Similarity", f"{scores['overall']:.0f}/100")
+    col2.metric("⏱️ Tempo", f"{scores['tempo']:.2f}× reference", help=f"{scores['duration_ms']} ms against {scores['reference_ms']} ms")
+    st.dataframe([
+        {
+            "Pada": p["pada"],
+            "Syllables": p["syllables"],
+            "Your timing": f"{p['start_ms']}–{p['end_ms']} ms",
+            "Reference": f"{p['reference_ms']} ms",
+            "Score": p["score"],
+        }
+        for p in scores["padas"]
+    ], hide_index=True, use_container_width=True)
+    st.caption(f"Scored locally in {scores['elapsed_ms']:.0f} ms")
+
+def stream_chat_reply(chat, prompt, placeholder):
+    """Streams the model's reply to ``prompt`` into ``placeholder`` and returns its latency metrics.
+
+    The ChatContext commits the turn to its transcript once the stream is fully consumed.
+    """
+    started = time.perf_counter()
+    first_token_at = None
+    text = ""
+    for piece in chat.send_message(prompt, stream=True):
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        text += piece
+        placeholder.markdown(text + "▌")
+    placeholder.markdown(text)
+    finished = time.perf_counter()
+    return {
+        "ttft_ms": ((first_token_at or finished) - started) * 1000,
+        "total_ms": (finished - started) * 1000,
+        "chars": len(text),
+        "streamed": True,
+    }
+
+def send_chat_reply(chat, prompt):
+    """Sends ``prompt`` without streaming and returns latency metrics in the same shape as stream_chat_reply."""
+    started = time.perf_counter()
+    reply = chat.send_message(prompt)
+    elapsed = (time.perf_counter() - started) * 1000
+    return {"ttft_ms": elapsed, "total_ms": elapsed, "chars": len(reply), "streamed": False}
+
+def record_response_metrics(metrics):
+    """Keeps the most recent per-message latency samples in the session."""
+    samples = st.session_state.setdefault("response_metrics", [])
+    samples.append(metrics)
+    del samples[:-RESPONSE_METRICS_KEPT]
+
+# --- Chat History Rendering ---
+def format_message_markdown(text):
+    """Prepares a message body for st.markdown, keeping verse lines that end in a danda (or IAST/HK "|") on their own lines."""
+    lines = text.split("\n")
+    return "\n".join(line + "  " if line.rstrip().endswith(("।", "॥", "|")) else line for line in lines)
+
+def display_text(text, script):
+    """``text`` with its Sanskrit shown in ``script``; None keeps it as written."""
+    return to_script(text, script) if script else text
+
+def render_chat_history(chat, cache_scope, fetch_earlier=None, audio_job=None):
+    """Renders the newest page of ``chat.transcript``, caching bodies per (``cache_scope``, script, message id) while on screen.
+
+    ``fetch_earlier()`` pulls an older page on demand; a finished ``audio_job`` plays if its message is still shown.
+    """
+    transcript = chat.transcript
+    script = st.session_state.get("display_script")
+    visible = st.session_state.setdefault("history_visible", CHAT_HISTORY_PAGE_SIZE)
+    previous = st.session_state.get("rendered_messages", {})
+    rendered = st.session_state.rendered_messages = {} # Only the bodies on screen stay cached
+    start = max(0, len(transcript) - visible)
+    can_fetch = fetch_earlier is not None and chat.has_earlier
+    if start > 0 or can_fetch:
+        label = f"⬆️ Load earlier messages ({start} hidden)" if start > 0 else "⬆️ Load earlier messages"
+        if st.button(label, key="load_earlier"):
+            if start == 0:
+                fetch_earlier()
+            st.session_state.history_visible += CHAT_HISTORY_PAGE_SIZE
+            st.rerun()
+    missing = [m for m in transcript[start:] if (cache_scope, script, m.id) not in previous]
+    if missing:
+        texts = [message_text(m) for m in missing]
+        if script:
+            texts = to_script_batch(texts, script)
+        previous.update({(cache_scope, script, m.id): format_message_markdown(t) for m, t in zip(missing, texts)})
+    for message in transcript[start:]:
+        cache_key = (cache_scope, script, message.id)
+        body = rendered[cache_key] = previous[cache_key]
+        is_model = message.role == "model"
+        with st.chat_message("SanskritAI" if is_model else "user", avatar="🤖" if is_model else "👤"):
+            st.markdown(body)
+            audio_output = None
+            if is_model and st.button("🔊 Play Audio", key=f"play_audio_{message.id}"):
+                audio_output = request_audio(message_text(message), "audio", context=(cache_scope, message.id))
+            elif audio_job is not None and audio_job.context == (cache_scope, message.id):
+                audio_output = job_audio(audio_job)
+            if audio_output:
+                st.audio(audio_output, format='audio/mp3', autoplay=True)
+
 # --- Theme Application Function ---
 def apply_theme(theme):
     """Apply different color themes based on selection."""
@@ -283,9 +2883,19 @@ def show_login_page():
         col1, col2 = st.columns(2)
         with col1:
             if st.button("🚀 Sign Up"):
-                st.session_state.logged_in = True
-                st.session_state.show_signup = False
-                st.rerun()
+                signup_id = (st.session_state.signup_email or st.session_state.signup_phone).strip().casefold()
+                store = account_store() if signup_id else None # Without an id (or a store) the session keeps no history
+                if signup_id in ADMIN_USERS:
+                    st.error("⚠️ This email or phone is reserved. Please log in instead.")
+                elif store is not None and not st.session_state.signup_password:
+                    st.error("⚠️ Please choose a password.")
+                elif store is not None and not store.create_account(signup_id, st.session_state.signup_password):
+                    st.error("⚠️ An account with this email or phone already exists. Please log in instead.")
+                else:
+                    st.session_state.user_id = signup_id if store is not None else None
+                    st.session_state.logged_in = True
+                    st.session_state.show_signup = False
+                    st.rerun()
         with col2:
             if st.button("⬅️ Back to Login"):
                 st.session_state.show_signup = False
@@ -297,11 +2907,20 @@ def show_login_page():
         col1, col2 = st.columns(2)
         with col1:
             if st.button("🔑 Login"):
-                if st.session_state.login_id and st.session_state.login_password:
+                login_id = st.session_state.login_id.strip().casefold()
+                store = account_store()
+                admin = login_id in ADMIN_USERS # Checked against the ADMIN_PASSWORD secret, never against a signup
+                if not (login_id and st.session_state.login_password):
+                    st.error("⚠️ Please enter your credentials.")
+                elif admin and not admin_password_matches(st.session_state.login_password):
+                    st.error("⚠️ Incorrect email/phone or password.")
+                elif not admin and store is not None and not store.verify_account(login_id, st.session_state.login_password):
+                    st.error("⚠️ Incorrect email/phone or password.")
+                else:
+                    st.session_state.user_id = login_id if store is not None else None
+                    st.session_state.is_admin = admin
                     st.session_state.logged_in = True
                     st.rerun()
-                else:
-                    st.error("⚠️ Please enter your credentials.")
         with col2:
             if st.button("✨ Create Account"):
                 st.session_state.show_signup = True
@@ -316,8 +2935,7 @@ def show_chatbot_page():
     # API Key Management
     try:
         google_api_key = st.secrets["GEMINI_API_KEY"]
-        genai.configure(api_key=google_api_key)
-        model = genai.GenerativeModel('gemini-1.5-flash')
+        model = get_model_registry(google_api_key).get()
     except (KeyError, FileNotFoundError):
         st.error("🚨 ERROR: API key not found.")
         st.stop()
@@ -326,108 +2944,208 @@ def show_chatbot_page():
         st.stop()
     
     # Initialize session state variables
-    if "chat" not in st.session_state: st.session_state.chat = None
-    if "total_questions" not in st.session_state: st.session_state.total_questions = 0
-    if "correct_answers" not in st.session_state: st.session_state.correct_answers = 0
-    if "messages_sent" not in st.session_state: st.session_state.messages_sent = 0
+    if "persona_chats" not in st.session_state: st.session_state.persona_chats = {}
+    if "messages_sent" not in st.session_state:
+        store, user_id = current_session_store()
+        stats = store.load_stats(user_id) if store is not None else {"messages_sent": 0, "total_questions": 0, "correct_answers": 0}
+        st.session_state.update(stats)
     if "quiz_mode" not in st.session_state: st.session_state.quiz_mode = False
     if "recitation_mode" not in st.session_state: st.session_state.recitation_mode = False
     if "shloka_to_recite" not in st.session_state: st.session_state.shloka_to_recite = None
     if "ai_persona" not in st.session_state: st.session_state.ai_persona = "General"
     if "voice_input_mode" not in st.session_state: st.session_state.voice_input_mode = False
+    if "shloka_progress" not in st.session_state: st.session_state.shloka_progress = {}
+    if "shloka_id" not in st.session_state: st.session_state.shloka_id = None
+    if "shloka_source" not in st.session_state: st.session_state.shloka_source = None
+    if "quiz_difficulty" not in st.session_state: st.session_state.quiz_difficulty = QUIZ_DIFFICULTIES[0]
 
-    # --- Persona Definitions ---
-    personas = {
-        "General": "You are 'SanskritAI', a helpful and encouraging AI tutor for the Sanskrit language.",
-        "Grammar (Pāṇini AI)": "You are Pāṇini AI, an expert in Sanskrit grammar based on the Aṣṭādhyāyī. Explain concepts with precision and cite sutras where possible.",
-        "Ayurveda (Charak AI)": "You are Charak AI, an expert on Ayurveda based on the Charaka Samhita. Answer questions about health, herbs, and principles, citing your source text.",
-        "Literature (Vyasa AI)": "You are Vyasa AI, a master of Sanskrit literature like the Mahabharata and Puranas. Recount stories and explain literary concepts, citing the epic you are referencing."
-    }
-    
-    # Initialize chat based on persona
-    if st.session_state.chat is None:
-        st.session_state.chat = model.start_chat(history=[
-            {'role': 'user', 'parts': [personas[st.session_state.ai_persona]]},
-            {'role': 'model', 'parts': ["नमस्ते! 🙏 Welcome to SanskritAI! How can I assist you today? ✨📚"]}
-        ])
+    # One lazily created chat per persona, so switching experts keeps each conversation
+    persona = st.session_state.ai_persona
+    persona_model = get_model_registry(google_api_key).with_system_instruction(persona_system_instruction(persona))
+    if persona not in st.session_state.persona_chats:
+        st.session_state.persona_chats[persona] = open_persona_chat(
+            persona_model,
+            persona,
+            "नमस्ते! 🙏 Welcome to SanskritAI! How can I assist you today? ✨📚",
+        )
+    st.session_state.chat = st.session_state.persona_chats[persona]
+    st.session_state.chat.model = persona_model # Picks up a refreshed context cache
+    st.session_state.chat.gateway = get_upstream_gateway()
+    st.session_state.chat.user_key = session_user_key()
+    enforce_session_memory()
 
+    @metric_labels(feature="quiz")
     def generate_quiz_question():
-        with st.spinner("🧠 Generating a new question..."):
-            try:
-                quiz_prompt = 'Generate a JSON object for a simple Sanskrit quiz question with keys: "question", "options", "answer", "explanation".'
-                response = model.generate_content(quiz_prompt)
-                json_response = response.text.replace("```json", "").replace("```", "").strip()
-                st.session_state.quiz_question = json.loads(json_response)
-                st.session_state.quiz_mode = True
-            except Exception as e:
-                st.error("😅 Sorry, I couldn't generate a quiz question.")
-                st.session_state.quiz_mode = False
+        persona = st.session_state.ai_persona
+        submit_job("quiz", "🧠 Generating a new question...", get_quiz_pool().take, model, persona, st.session_state.quiz_difficulty, PERSONAS[persona])
+
+    @metric_labels(feature="recitation")
+    def start_recitation(text, shloka_id=None, source=None):
+        st.session_state.shloka_to_recite = text
+        st.session_state.shloka_id = shloka_id
+        st.session_state.shloka_source = source
+        st.session_state.recitation_mode = True
+        st.session_state.quiz_mode = False # The shloka replaces any quiz on screen
+        prefetch_audio(text) # The reference recording for Listen first and for scoring
 
+    @metric_labels(feature="recitation")
     def get_shloka_for_recitation():
-        with st.spinner("📜 Choosing a shloka for you..."):
-            try:
-                shloka_prompt = "Provide a short, well-known Sanskrit shloka in Devanagari script for a user to practice reciting."
-                response = model.generate_content(shloka_prompt)
-                st.session_state.shloka_to_recite = response.text
-                st.session_state.recitation_mode = True
-            except Exception as e:
-                st.error("😅 Sorry, I couldn't fetch a shloka right now.")
+        request = st.session_state.get("shloka_request", "").strip()
+        difficulty = QUIZ_DIFFICULTIES.index(st.session_state.quiz_difficulty) + 1
+        try:
+            corpus = get_shloka_corpus()
+            shloka_id = corpus.select(difficulty, request, st.session_state.shloka_progress)
+        except (OSError, ValueError):
+            shloka_id = None # Corpus unavailable: fall back to the model
+        if shloka_id is not None:
+            shloka = corpus.get(shloka_id)
+            start_recitation(shloka["text"], shloka_id, f"{shloka['source']} {shloka['ref']}".strip() + f" · {shloka['meter']}")
+            return
+        shloka_prompt = "Provide a short, well-known Sanskrit shloka in Devanagari script for a user to practice reciting."
+        if request:
+            shloka_prompt += f" The user asked for: {request}."
+        submit_job("shloka", "📜 Choosing a shloka for you...", upstream_caller(), model.generate_content, shloka_prompt)
+
+    # Apply the results of background jobs that finished since the last rerun. Audio jobs are taken
+    # whatever screen is showing, so one the current screen can't play is dropped rather than left to rerun the page
+    audio_job = finished_job("audio")
+    listen_job = finished_job("listen")
+    transcription_job = finished_job("transcription") # A message typed or recorded meanwhile takes its place
+    quiz_job = finished_job("quiz")
+    if quiz_job is not None:
+        try:
+            question = quiz_job.future.result()
+        except Exception:
+            question = None
+        if question is not None:
+            st.session_state.quiz_question = question
+            st.session_state.quiz_answer = None
+            st.session_state.quiz_mode = True
+        else:
+            st.error("😅 Sorry, I couldn't generate a quiz question.")
+            st.session_state.quiz_mode = False
+    shloka_job = finished_job("shloka")
+    if shloka_job is not None:
+        try:
+            start_recitation(shloka_job.future.result().text)
+        except Exception:
+            st.error("😅 Sorry, I couldn't fetch a shloka right now.")
+    voice_job = finished_job("voice")
+    if voice_job is not None:
+        voice_chat, voice_persona, started = voice_job.context
+        try:
+            transcript, reply = voice_job.future.result()
+        except Exception as e:
+            st.error(f"😅 Could not understand your audio: {str(e)}")
+        else:
+            if st.session_state.get("quiz_answer") is not None:
+                st.session_state.quiz_mode = False # As for a typed message
+            voice_chat.record_turn(transcript, reply)
+            elapsed = (time.perf_counter() - started) * 1000
+            cache_query = cacheable_query(transcript)
+            if cache_query:
+                get_response_cache().put(voice_persona, cache_query, reply)
+            record_stat("messages_sent")
+            record_response_metrics({"ttft_ms": elapsed, "total_ms": elapsed, "chars": len(reply), "streamed": False})
+            with metric_labels(feature="voice"):
+                prefetch_audio(reply)
+                get_metrics_registry().inc("sanskritai_replies_total", source="model")
 
     # Display chat history or special modes
     if st.session_state.quiz_mode:
         q = st.session_state.quiz_question
+        answered = st.session_state.get("quiz_answer")
         st.markdown('<div class="quiz-container">', unsafe_allow_html=True)
         st.info(f"🧩 **Quiz Time!**\n\n{q['question']}")
         cols = st.columns(len(q.get('options', [])))
         for i, option in enumerate(q.get('options', [])):
-            if cols[i].button(f"{chr(65+i)}. {option}", key=f"opt_{i}", use_container_width=True):
-                st.session_state.total_questions += 1
-                if option == q['answer']: 
-                    st.session_state.correct_answers += 1
-                    st.success(f"🎉 Excellent! The answer is **{q['answer']}**.")
-                else: 
-                    st.error(f"🤔 Not quite. The correct answer was **{q['answer']}**.")
-                if 'explanation' in q: st.info(f"💡 **Explanation:** {q['explanation']}")
+            if cols[i].button(f"{chr(65+i)}. {option}", key=f"opt_{i}", use_container_width=True, disabled=answered is not None):
+                record_stat("total_questions")
+                if option == q['answer']: record_stat("correct_answers")
+                answered = st.session_state.quiz_answer = option
+        if answered is not None: # Drawn outside the option loop so its own click reaches it on the next rerun
+            if answered == q['answer']:
+                st.success(f"🎉 Excellent! The answer is **{q['answer']}**.")
+            else:
+                st.error(f"🤔 Not quite. The correct answer was **{q['answer']}**.")
+            if 'explanation' in q: st.info(f"💡 **Explanation:** {q['explanation']}")
+            next_col, back_col = st.columns(2)
+            if next_col.button("🔄 Next Question", key="next_q", use_container_width=True):
                 st.session_state.quiz_mode = False
-                if st.button("🔄 Next Question", key="next_q"): 
-                    generate_quiz_question()
-                    st.rerun()
-                st.stop()
+                generate_quiz_question()
+                st.rerun()
+            if back_col.button("💬 Back to Chat", key="quiz_back", use_container_width=True):
+                st.session_state.quiz_mode = False
+                st.rerun()
         st.markdown('</div>', unsafe_allow_html=True)
     elif st.session_state.recitation_mode:
-        st.info(f"**Recitation Practice!**\n\nPlease recite the following shloka:\n\n### {st.session_state.shloka_to_recite}")
-        recitation_audio = mic_recorder(start_prompt="🎤 Start Recitation", stop_prompt="⏹️ Stop", key='recite_recorder')
-        if recitation_audio:
-            with st.spinner("🧘 Analyzing your recitation..."):
-                try:
-                    audio_io = io.BytesIO(recitation_audio['bytes'])
-                    audio_file = genai.upload_file(audio_io, mime_type="audio/wav")
-                    feedback_prompt = f"A user recited this Sanskrit shloka: '{st.session_state.shloka_to_recite}'. This is their audio recording. Please listen and provide constructive feedback on their pronunciation and clarity in a friendly tone."
-                    response = model.generate_content([feedback_prompt, audio_file])
-                    st.success("**Feedback on your recitation:**")
-                    st.markdown(response.text)
-                    genai.delete_file(audio_file.name)
-                    st.session_state.recitation_mode = False
-                    if st.button("Try another shloka"):
-                        get_shloka_for_recitation()
-                        st.rerun()
-                except Exception as e:
-                    st.error(f"😅 Could not analyze your recitation: {str(e)}")
+        with metric_labels(feature="recitation"):
+            shown_shloka = display_text(st.session_state.shloka_to_recite, st.session_state.get("display_script"))
+            shloka_lines = "\n".join(f"### {line}" for line in shown_shloka.splitlines() if line.strip())
+            st.info(f"**Recitation Practice!**\n\nPlease recite the following shloka:\n\n{shloka_lines}")
+            if st.session_state.shloka_source:
+                st.caption(f"📖 {st.session_state.shloka_source}")
+            col1, col2 = st.columns(2)
+            if col1.button("🔊 Listen first"):
+                reference_audio = request_audio(st.session_state.shloka_to_recite, "listen")
+            else:
+                reference_audio = job_audio(listen_job) if listen_job is not None else None
+            if reference_audio:
+                st.audio(reference_audio, format='audio/mp3', autoplay=True)
+            col2.toggle("⚡ Quick practice", key="quick_practice", help="Show the local scores only, without AI-written feedback.")
+            recitation_audio = mic_recorder(start_prompt="🎤 Start Recitation", stop_prompt="⏹️ Stop", format="wav", key='recite_recorder')
+            if recitation_audio:
+                with st.spinner("🧘 Analyzing your recitation..."):
+                    try:
+                        shloka_text = st.session_state.shloka_to_recite
+                        scores = None
+                        if st.session_state.shloka_id is not None: # Corpus text is exactly what was asked for, so it can be the reference
+                            try:
+                                scores = score_recitation(recitation_audio['bytes'], reference_recitation(shloka_text), shloka_text)
+                            except Exception:
+                                scores = None # No reference audio or no MP3 decoder: let the model listen instead
+                        if scores is not None:
+                            render_recitation_scores(scores)
+                            if not st.session_state.get("quick_practice"):
+                                try:
+                                    response = call_upstream(model.generate_content, recitation_feedback_prompt(shloka_text, scores))
+                                    st.success("**Feedback on your recitation:**")
+                                    st.markdown(response.text)
+                                except Exception:
+                                    st.caption("AI feedback is unavailable right now; the scores above are complete.")
+                        else:
+                            feedback_prompt = f"A user recited this Sanskrit shloka: '{shloka_text}'. This is their audio recording. Please listen and provide constructive feedback on their pronunciation and clarity in a friendly tone."
+                            with audio_part(recitation_audio['bytes']) as recording:
+                                response = call_upstream(model.generate_content, [feedback_prompt, recording])
+                            st.success("**Feedback on your recitation:**")
+                            st.markdown(response.text)
+                        if st.session_state.shloka_id is not None:
+                            passed = scores is None or scores["overall"] >= RECITATION_PASS_SCORE
+                            ShlokaCorpus.record_practice(st.session_state.shloka_progress, st.session_state.shloka_id, success=passed)
+                        st.session_state.recitation_mode = False
+                        if st.button("Try another shloka"):
+                            get_shloka_for_recitation()
+                            st.rerun()
+                    except Exception as e:
+                        st.error(f"😅 Could not analyze your recitation: {str(e)}")
+                    finally:
+                        spill_recording("recite_recorder")
     else:
         # Display chat history
-        for i, message in enumerate(st.session_state.chat.history[1:]):
-            with st.chat_message("SanskritAI" if message.role == "model" else "user", avatar="🤖" if message.role == "model" else "👤"):
-                st.markdown(message.parts[0].text)
-                if message.role == "model":
-                    if st.button("🔊 Play Audio", key=f"play_audio_{i}"):
-                        audio_output = text_to_audio(message.parts[0].text)
-                        if audio_output:
-                            st.audio(audio_output, format='audio/mp3', autoplay=True)
+        with metric_labels(feature="chat"):
+            render_chat_history(st.session_state.chat, persona, lambda: load_earlier_history(st.session_state.chat, persona), audio_job)
+    screen_job = "listen" if st.session_state.recitation_mode else None if st.session_state.quiz_mode else "audio"
+    usable_jobs = tuple(name for name in st.session_state.get("background_jobs", {}) if name in PAGE_JOBS or name == screen_job)
+    if usable_jobs:
+        watch_background_jobs(usable_jobs)
+
+    if "chat_error" in st.session_state:
+        st.error(st.session_state.pop("chat_error"))
 
     # User Input Section with Audio
     if st.session_state.voice_input_mode:
         st.info("Please record your message now.")
-        audio_bytes = mic_recorder(start_prompt="🎤 Start Recording", stop_prompt="⏹️ Stop Recording", key='recorder')
+        audio_bytes = mic_recorder(start_prompt="🎤 Start Recording", stop_prompt="⏹️ Stop Recording", format="wav", key='recorder')
         if st.button("Cancel"):
             st.session_state.voice_input_mode = False
             st.rerun()
@@ -445,44 +3163,90 @@ def show_chatbot_page():
     final_user_input = None
     if user_prompt:
         final_user_input = user_prompt
+    elif audio_bytes and VOICE_SINGLE_TURN:
+        st.session_state.voice_input_mode = False # Exit voice mode after recording
+        chat = st.session_state.chat
+        with metric_labels(feature="voice"):
+            submit_job("voice", "🎧 Listening to your question...", answer_voice_question, chat, audio_bytes['bytes'], upstream_caller(),
+                       context=(chat, st.session_state.ai_persona, time.perf_counter()))
+        spill_recording("recorder")
+        st.rerun()
     elif audio_bytes:
         st.session_state.voice_input_mode = False # Exit voice mode after recording
-        with st.spinner("🎧 Transcribing your voice..."):
-            try:
-                audio_io = io.BytesIO(audio_bytes['bytes'])
-                audio_file = genai.upload_file(audio_io, mime_type="audio/wav")
-                feedback_prompt = "Transcribe this audio recording."
-                response = model.generate_content([feedback_prompt, audio_file])
-                final_user_input = response.text.strip()
-                genai.delete_file(audio_file.name)
-            except Exception as e:
-                st.error(f"😅 Could not transcribe your audio: {str(e)}")
+        with metric_labels(feature="voice"):
+            submit_job("transcription", "🎧 Transcribing your voice...", transcribe_recording, model, audio_bytes['bytes'], upstream_caller())
+        spill_recording("recorder")
+        st.rerun()
+    elif transcription_job is not None:
+        try:
+            final_user_input = transcription_job.future.result()
+        except Exception as e:
+            st.error(f"😅 Could not transcribe your audio: {str(e)}")
 
     if final_user_input:
-        st.session_state.messages_sent += 1
-        try:
-            st.session_state.chat.send_message(final_user_input)
-        except Exception as e: 
-            st.error(f"⚠️ An error occurred: {e}")
-        st.rerun()
+        if st.session_state.get("quiz_answer") is not None:
+            st.session_state.quiz_mode = False # A new message leaves an answered quiz, so its reply shows in the chat
+        with metric_labels(feature="chat"):
+            record_stat("messages_sent")
+            response_cache = get_response_cache()
+            started = time.perf_counter()
+            cache_query = None
+            cached_reply = lexicon_reply(st.session_state.ai_persona, final_user_input)
+            reply_source = "lexicon"
+            if cached_reply is None:
+                reply_source = "cache"
+                cache_query = cacheable_query(final_user_input)
+                cached_reply = response_cache.get(st.session_state.ai_persona, cache_query) if cache_query else None
+            try:
+                if cached_reply is not None:
+                    st.session_state.chat.record_turn(final_user_input, cached_reply)
+                    elapsed = (time.perf_counter() - started) * 1000
+                    record_response_metrics({"ttft_ms": elapsed, "total_ms": elapsed, "chars": len(cached_reply), "streamed": False})
+                elif STREAM_RESPONSES:
+                    with st.chat_message("user", avatar="👤"):
+                        st.markdown(final_user_input)
+                    with st.chat_message("SanskritAI", avatar="🤖"):
+                        metrics = stream_chat_reply(st.session_state.chat, final_user_input, st.empty())
+                else:
+                    with st.spinner("🤔 Thinking..."):
+                        metrics = send_chat_reply(st.session_state.chat, final_user_input)
+                if cached_reply is None:
+                    record_response_metrics(metrics)
+                    if cache_query:
+                        response_cache.put(st.session_state.ai_persona, cache_query, st.session_state.chat.transcript[-1].text)
+                prefetch_audio(message_text(st.session_state.chat.transcript[-1]))
+                get_metrics_registry().inc("sanskritai_replies_total", source=reply_source if cached_reply is not None else "model")
+            except Exception as e: 
+                st.session_state.chat_error = f"⚠️ An error occurred: {e}" # Shown after the rerun below
+            st.rerun()
 
     # Sidebar
     with st.sidebar:
         st.markdown("### 🧠 Choose AI Persona")
-        selected_persona = st.selectbox("Select AI Expert", options=list(personas.keys()))
+        selected_persona = st.selectbox("Select AI Expert", options=list(PERSONAS.keys()))
         if selected_persona != st.session_state.ai_persona:
             st.session_state.ai_persona = selected_persona
-            st.session_state.chat = None # Reset chat to apply new persona
+            st.session_state.history_visible = CHAT_HISTORY_PAGE_SIZE
             st.rerun()
+        st.selectbox(
+            "🔤 Show Sanskrit in", options=[None, *SCRIPT_LABELS], key="display_script",
+            format_func=lambda script: SCRIPT_LABELS.get(script, "Script as written"),
+        )
 
         st.markdown("### 🚀 Quick Actions")
+        st.selectbox("🎚️ Difficulty", options=QUIZ_DIFFICULTIES, key="quiz_difficulty", help="Used for quiz questions and recitation shlokas.")
         if st.button("🧩 Start Quiz", use_container_width=True):
             generate_quiz_question()
             st.rerun()
+        st.text_input("📜 Shloka from (optional)", key="shloka_request", placeholder="e.g. Gita, Upanishad, Anushtubh")
         if st.button("🗣️ Recite a Shloka", use_container_width=True):
             get_shloka_for_recitation()
             st.rerun()
         if st.button("🚪 Logout", use_container_width=True):
+            store, _ = current_session_store()
+            if store is not None:
+                store.flush() # Make this session's history visible to the next login right away (bounded wait)
+            release_session_memory()
             st.session_state.logged_in = False
             for key in list(st.session_state.keys()): del st.session_state[key]
             st.rerun()
@@ -495,6 +3259,71 @@ def show_chatbot_page():
             st.metric("🎯 Quiz Accuracy", f"{accuracy:.1f}%")
         else:
             st.metric("🎯 Quiz Accuracy", "No quizzes yet")
+        if st.session_state.get("response_metrics"):
+            samples = st.session_state.response_metrics
+            last = samples[-1]
+            avg_ttft = sum(m["ttft_ms"] for m in samples) / len(samples)
+            st.metric("⚡ First Token", f"{last['ttft_ms']:.0f} ms", help=f"Average over the last {len(samples)} replies: {avg_ttft:.0f} ms")
+            st.caption(f"Full reply in {last['total_ms']:.0f} ms")
+        if is_admin():
+            with st.expander("🛠️ Session Memory"):
+                count, total, heaviest = get_session_memory_registry().heaviest()
+                st.caption(f"{count} active sessions · {total / 2 ** 20:.1f} MB resident · cap {SESSION_MEMORY_LIMIT_BYTES / 2 ** 20:.1f} MB each")
+                now = time.time()
+                st.dataframe([
+                    {
+                        "User": entry["user"] or "(anonymous)",
+                        "Session": entry["session"][:8],
+                        "Resident KB": round(entry["bytes"] / 1024, 1),
+                        "Spilled KB": round(entry["spilled"] / 1024, 1),
+                        "Largest": f"{entry['largest']} ({entry['largest_bytes'] / 1024:.0f} KB)",
+                        "Idle s": round(now - entry["seen"]),
+                    }
+                    for entry in heaviest
+                ], hide_index=True, use_container_width=True)
+                store, _ = current_session_store()
+                if store is not None:
+                    store_stats = store.stats()
+                    st.caption(f"Session store: {store_stats['pending_writes']} writes queued · {store_stats['dropped_writes']} dropped")
+                    if store_stats["dropped_writes"]:
+                        st.warning(f"⚠️ {store_stats['dropped_writes']} history writes were lost. Last error: {store_stats['last_error']}")
+            with st.expander("📈 Metrics"):
+                server = start_metrics_server()
+                if server is not None:
+                    st.caption(f"Prometheus endpoint: http://{METRICS_HOST}:{server.server_address[1]}/metrics")
+                else:
+                    st.caption("Prometheus endpoint off (SANSKRITAI_METRICS_PORT=0, or another process holds the port)")
+                rows = get_metrics_registry().summary()
+                live = [row for row in rows if not row["labels"]] # Queues and caches, read just now
+                units = {"seconds": ("ms", 1000), "bytes": ("KB", 1 / 1024)}
+                st.dataframe([
+                    {
+                        "Metric": row["metric"].removeprefix("sanskritai_"),
+                        "Persona": row["labels"].pop("persona"),
+                        "Feature": row["labels"].pop("feature"),
+                        "Labels": ", ".join(f"{k}={v}" for k, v in row["labels"].items()),
+                        "Count": row["count"],
+                        "Unit": unit,
+                        "Mean": round(row["mean"] * scale, 1),
+                        "p50": round(row["p50"] * scale, 1),
+                        "p95": round(row["p95"] * scale, 1),
+                    }
+                    for row in rows if "count" in row
+                    for unit, scale in [units[row["metric"].rsplit("_", 1)[1]]]
+                ], hide_index=True, use_container_width=True)
+                if live:
+                    st.markdown("**Queues and caches**")
+                    st.dataframe([
+                        {"Metric": row["metric"].removeprefix("sanskritai_"), "Kind": row["kind"], "Value": row["value"]}
+                        for row in live
+                    ], hide_index=True, use_container_width=True)
+                errors = [row for row in rows if row["labels"].get("outcome", "ok") not in ("ok", "RerunException", "StopException")]
+                if errors:
+                    st.markdown("**Errors**")
+                    st.dataframe([
+                        {"Metric": row["metric"].removeprefix("sanskritai_"), **row["labels"], "Count": row["value"]}
+                        for row in errors
+                    ], hide_index=True, use_container_width=True)
         st.markdown("---")
         st.markdown("### 🎨 Theme")
         theme = st.selectbox("Choose Theme", ["🌅 Sunrise (Default)", "🌙 Moonlight", "🌸 Cherry Blossom", "🏔️ Mountain"])
@@ -503,7 +3332,8 @@ def show_chatbot_page():
 
 # --- App Logic ---
 load_css()
+start_metrics_server()
 if not st.session_state.get("logged_in", False):
-    show_login_page()
+    instrumented_rerun(show_login_page)
 else:
-    show_chatbot_page()
+    instrumented_rerun(show_chatbot_page)
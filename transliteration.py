@@ -0,0 +1,229 @@
+# transliteration.py - Sanskrit script conversion for SanskritAI
+"""Table-driven transliteration between Devanagari, IAST, Harvard-Kyoto and SLP1.
+
+Every scheme is described by one aligned table (vowels, consonants, signs), from
+which each (source, target) pair is compiled once at import into a longest-match
+regular expression and a lookup table. Devanagari input takes a faster path that
+stays in C: one str.translate writes every consonant with its inherent "a" and marks
+vowel signs and viramas, then one str.replace drops the "a" in front of each mark.
+Roman input is tokenized by longest match ("kh" before "k", "ai" before "a"), and a
+consonant that isn't followed by a vowel gets a virama when written in Devanagari.
+
+IAST input is case-insensitive; Harvard-Kyoto and SLP1 are case-sensitive by design.
+Characters outside a scheme (Latin text next to Devanagari, digits, punctuation) pass
+through unchanged, so mixed chat messages can be converted as they are.
+
+Run this file to benchmark throughput in MB/s for every pair of schemes.
+"""
+import re
+import unicodedata
+
+SCRIPTS = ("devanagari", "iast", "hk", "slp1")
+SCRIPT_LABELS = {"devanagari": "Devanagari", "iast": "IAST", "hk": "Harvard-Kyoto", "slp1": "SLP1"}
+
+# (Devanagari letter, Devanagari vowel sign, IAST, Harvard-Kyoto, SLP1)
+VOWELS = [
+    ("अ", "", "a", "a", "a"), ("आ", "ा", "ā", "A", "A"), ("इ", "ि", "i", "i", "i"), ("ई", "ी", "ī", "I", "I"),
+    ("उ", "ु", "u", "u", "u"), ("ऊ", "ू", "ū", "U", "U"), ("ऋ", "ृ", "ṛ", "R", "f"), ("ॠ", "ॄ", "ṝ", "RR", "F"),
+    ("ऌ", "ॢ", "ḷ", "lR", "x"), ("ॡ", "ॣ", "ḹ", "lRR", "X"), ("ए", "े", "e", "e", "e"), ("ऐ", "ै", "ai", "ai", "E"),
+    ("ओ", "ो", "o", "o", "o"), ("औ", "ौ", "au", "au", "O"),
+]
+# (Devanagari, IAST, Harvard-Kyoto, SLP1)
+CONSONANTS = [
+    ("क", "k", "k", "k"), ("ख", "kh", "kh", "K"), ("ग", "g", "g", "g"), ("घ", "gh", "gh", "G"), ("ङ", "ṅ", "G", "N"),
+    ("च", "c", "c", "c"), ("छ", "ch", "ch", "C"), ("ज", "j", "j", "j"), ("झ", "jh", "jh", "J"), ("ञ", "ñ", "J", "Y"),
+    ("ट", "ṭ", "T", "w"), ("ठ", "ṭh", "Th", "W"), ("ड", "ḍ", "D", "q"), ("ढ", "ḍh", "Dh", "Q"), ("ण", "ṇ", "N", "R"),
+    ("त", "t", "t", "t"), ("थ", "th", "th", "T"), ("द", "d", "d", "d"), ("ध", "dh", "dh", "D"), ("न", "n", "n", "n"),
+    ("प", "p", "p", "p"), ("फ", "ph", "ph", "P"), ("ब", "b", "b", "b"), ("भ", "bh", "bh", "B"), ("म", "m", "m", "m"),
+    ("य", "y", "y", "y"), ("र", "r", "r", "r"), ("ल", "l", "l", "l"), ("व", "v", "v", "v"),
+    ("श", "ś", "z", "S"), ("ष", "ṣ", "S", "z"), ("स", "s", "s", "s"), ("ह", "h", "h", "h"), ("ळ", "ḻ", "L", "L"),
+]
+# (Devanagari, IAST, Harvard-Kyoto, SLP1): anusvara, visarga, candrabindu, avagraha, dandas
+SIGNS = [
+    ("ं", "ṃ", "M", "M"), ("ः", "ḥ", "H", "H"), ("ँ", "m̐", "~", "~"), ("ऽ", "'", "'", "'"),
+    ("।", "|", "|", "."), ("॥", "||", "||", ".."),
+]
+# Alternative spellings accepted on input only
+INPUT_VARIANTS = {"iast": {"ṁ": "ṃ", "r̥̄": "ṝ", "r̥": "ṛ", "l̥̄": "ḹ", "l̥": "ḷ"}} # ISO 15919 spellings
+VIRAMA = "्"
+NUKTA = "़"
+OM = ("ॐ", "oṃ", "oM", "oM") # A word-initial oṃ reads back as ॐ
+DEVANAGARI_DIGITS = "०१२३४५६७८९"
+ROMAN_COLUMN = {"iast": 1, "hk": 2, "slp1": 3}
+
+def _roman(row, scheme):
+    """A scheme's spelling from a CONSONANTS/SIGNS row."""
+    return row[ROMAN_COLUMN[scheme]]
+
+def _vowel(row, scheme):
+    return row[0] if scheme == "devanagari" else row[ROMAN_COLUMN[scheme] + 1]
+
+def _alternation(tokens):
+    return "|".join(re.escape(t) for t in sorted(set(tokens), key=len, reverse=True))
+
+INHERENT_MARK = "\x7f" # Written for vowel signs and viramas, then removed with the "a" before it
+
+def _compile_from_devanagari(target):
+    table = {ord(row[0]): _roman(row, target) + "a" for row in CONSONANTS}
+    table.update({ord(row[0]): _roman(row, target) for row in SIGNS})
+    for row in VOWELS:
+        table[ord(row[0])] = _vowel(row, target)
+        if row[1]:
+            table[ord(row[1])] = INHERENT_MARK + _vowel(row, target)
+    table[ord(OM[0])] = _roman(OM, target)
+    table[ord(VIRAMA)] = INHERENT_MARK
+    table[ord(NUKTA)] = "" # No distinct letters for nukta consonants in these schemes
+    table.update({ord(d): str(i) for i, d in enumerate(DEVANAGARI_DIGITS)})
+    return table
+
+def _compile_from_roman(source, target):
+    """Returns (token regex, token -> output) for a roman source scheme."""
+    vowels = {_vowel(row, source): row for row in VOWELS}
+    consonants = {_roman(row, source): row for row in CONSONANTS}
+    signs = {_roman(row, source): row for row in SIGNS + [OM]}
+    if target == "devanagari":
+        # One match per syllable: a standalone oṃ, a consonant and the vowel after it, or a lone vowel, sign or digit
+        pattern = re.compile(
+            f"(?<!\\w)({re.escape(_roman(OM, source))})(?!\\w)|({_alternation(consonants)})({_alternation(vowels)})?"
+            f"|({_alternation(vowels)})|({_alternation(signs)})|([0-9])"
+        )
+        return pattern, {"vowels": vowels, "consonants": consonants, "signs": signs}
+    output = {token: _vowel(row, target) for token, row in vowels.items()}
+    output.update({token: _roman(row, target) for token, row in consonants.items()})
+    output.update({token: _roman(row, target) for token, row in signs.items()})
+    return re.compile(_alternation(output)), output
+
+def _prepare(text, source):
+    text = unicodedata.normalize("NFC", text) # Also splits precomposed nukta letters into letter + nukta
+    if source != "iast":
+        return text
+    text = text.lower()
+    for variant, canonical in INPUT_VARIANTS["iast"].items():
+        if variant in text:
+            text = text.replace(variant, canonical)
+    return text
+
+COMPILED = {}
+for _source in SCRIPTS:
+    for _target in SCRIPTS:
+        if _source == _target:
+            continue
+        if _source == "devanagari":
+            COMPILED[_source, _target] = _compile_from_devanagari(_target)
+        else:
+            COMPILED[_source, _target] = _compile_from_roman(_source, _target)
+
+def _roman_to_devanagari(text, pattern, tables):
+    vowels, consonants, signs = tables["vowels"], tables["consonants"], tables["signs"]
+
+    def syllable(match):
+        om, consonant, vowel, lone_vowel, sign, digit = match.groups()
+        if om is not None:
+            return OM[0]
+        if consonant is not None:
+            letter = consonants[consonant][0]
+            if vowel is None:
+                return letter + VIRAMA
+            return letter + vowels[vowel][1]
+        if lone_vowel is not None:
+            return vowels[lone_vowel][0]
+        if sign is not None:
+            return signs[sign][0]
+        return DEVANAGARI_DIGITS[int(digit)]
+
+    return pattern.sub(syllable, text)
+
+def transliterate(text, source, target):
+    """Converts ``text`` from ``source`` to ``target`` (any of SCRIPTS)."""
+    if source == target or not text:
+        return text
+    text = _prepare(text, source)
+    compiled = COMPILED[source, target]
+    if source == "devanagari":
+        text = text.translate(compiled)
+        if INHERENT_MARK in text:
+            # A vowel sign or virama with no consonant before it leaves a stray mark
+            text = text.replace("a" + INHERENT_MARK, "").replace(INHERENT_MARK, "")
+        return text
+    pattern, output = compiled
+    if target == "devanagari":
+        return _roman_to_devanagari(text, pattern, output)
+    return pattern.sub(lambda match: output[match.group()], text)
+
+BATCH_SEPARATOR = "\x00" # Outside every scheme, so it passes through untouched and ends a syllable
+
+def transliterate_batch(texts, source, target):
+    """Converts many strings in one pass over their concatenation. Returns a list in the same order."""
+    texts = list(texts)
+    if not texts:
+        return []
+    joined = transliterate(BATCH_SEPARATOR.join(t.replace(BATCH_SEPARATOR, "") for t in texts), source, target)
+    return joined.split(BATCH_SEPARATOR)
+
+DEVANAGARI_RUN = re.compile(r"[ऀ-ॿ]+(?:[\s'|.,;:!?-]+[ऀ-ॿ]+)*")
+IAST_WORD = re.compile(r"(?<![\w'])[\w']*[āīūṛṝḷḹṅñṭḍṇśṣṃṁḥ][\w']*", re.IGNORECASE)
+
+def to_script(text, target):
+    """Shows mixed prose in ``target``: converts Devanagari runs to a roman scheme, or IAST words to Devanagari.
+
+    Only words with IAST diacritics count as Sanskrit when converting to Devanagari,
+    since plain ASCII words can't be told apart from English.
+    """
+    if target == "devanagari":
+        return IAST_WORD.sub(lambda match: transliterate(match.group(), "iast", "devanagari"), text)
+    if "ऀ" > max(text, default=" "):
+        return text # No Devanagari at all
+    return DEVANAGARI_RUN.sub(lambda match: transliterate(match.group(), "devanagari", target), text)
+
+def to_script_batch(texts, target):
+    """to_script for many strings, converting all Devanagari runs to a roman scheme in one batch."""
+    texts = list(texts)
+    if target == "devanagari":
+        return [to_script(text, target) for text in texts]
+    runs = [(i, match) for i, text in enumerate(texts) for match in DEVANAGARI_RUN.finditer(text)]
+    converted = iter(transliterate_batch((match.group() for _, match in runs), "devanagari", target))
+    pieces = [[] for _ in texts]
+    cursors = [0] * len(texts)
+    for (i, match), new in zip(runs, converted):
+        pieces[i] += [texts[i][cursors[i]:match.start()], new]
+        cursors[i] = match.end()
+    return ["".join(pieces[i]) + texts[i][cursors[i]:] for i in range(len(texts))]
+
+# --- Microbenchmark ---
+def benchmark(megabytes=4.0, repeat=3):
+    """Times every (source, target) pair on the bundled shloka corpus, repeated to about ``megabytes`` of UTF-8 input."""
+    import json
+    import os
+    import time
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "shlokas.json")
+    with open(path, encoding="utf-8") as f:
+        verses = [entry["text"] for entry in json.load(f)]
+    corpora = {"devanagari": verses}
+    for scheme in SCRIPTS[1:]:
+        corpora[scheme] = transliterate_batch(verses, "devanagari", scheme)
+    results = []
+    for source in SCRIPTS:
+        sample = corpora[source]
+        size = sum(len(v.encode("utf-8")) for v in sample)
+        texts = sample * max(1, int(megabytes * 2 ** 20 / size))
+        total = size * (len(texts) // len(sample))
+        for target in SCRIPTS:
+            if target == source:
+                continue
+            best = float("inf")
+            for _ in range(repeat):
+                started = time.perf_counter()
+                transliterate_batch(texts, source, target)
+                best = min(best, time.perf_counter() - started)
+            results.append((source, target, total / 2 ** 20 / best))
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megabytes", type=float, default=4.0, help="input size per pair (default 4)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per pair; the fastest is reported (default 3)")
+    args = parser.parse_args()
+    print(f"{'source':<12}{'target':<12}{'MB/s':>8}")
+    for source, target, rate in benchmark(args.megabytes, args.repeat):
+        print(f"{source:<12}{target:<12}{rate:>8.1f}")